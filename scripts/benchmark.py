@@ -0,0 +1,258 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import polars as pl
+
+from common import (
+    DATA_DIR,
+    DATASET_SCHEMAS,
+    FOREIGN_KEYS,
+    IdAllocator,
+    day_rng,
+    get_s3_client,
+    list_dataset_parts,
+    random_choice,
+    read_dataset,
+    reference_keys,
+    update_dataset,
+    write_dataset,
+)
+from generate_order_lines import READS as ORDER_LINES_READS, generate_order_lines
+from generate_returns import READS as RETURNS_READS, generate_returns
+
+# Checked-in datasets the fixtures are scaled from.
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "data")
+# Datasets copied into a fixture, with the key columns suffixed per copy so
+# keys stay unique and references stay consistent. The product catalog is
+# copied once at every scale.
+FIXTURE_KEYS = {
+    "customer.csv": ["customer_id"],
+    "orders.csv": ["order_id"],
+    "returns.csv": ["return_id", "order__order_id", "customer__customer_id"],
+    "monthly_inventory.csv": ["monthly_inventory_id"],
+    "product.csv": None,
+}
+# Benchmarked stages, in the order they run against a fixture (update_dataset changes it, so it runs last).
+STAGES = ["write_dataset", "read_dataset", "generate_order_lines", "generate_returns", "update_dataset"]
+BACKENDS = ["local", "s3"]
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def storage_bytes(keys=None):
+    """Total size of the given dataset keys, or of everything stored, on the configured backend."""
+    if os.getenv("USE_S3", "false").lower() == "true":
+        sizes = {}
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=os.getenv("AWS_S3_BUCKET")):
+            sizes.update({obj["Key"]: obj["Size"] for obj in page.get("Contents", [])})
+        return sum(sizes.get(k, 0) for k in keys) if keys is not None else sum(sizes.values())
+    if keys is None:
+        keys = [
+            os.path.relpath(os.path.join(root, name), DATA_DIR)
+            for root, _, names in os.walk(DATA_DIR) for name in names
+        ]
+    paths = [os.path.join(DATA_DIR, k) for k in keys]
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def build_fixture(scale):
+    """Write `scale` copies of every checked-in dataset to the configured backend; returns the rows written."""
+    rows = 0
+    for filename, keys in FIXTURE_KEYS.items():
+        df = pl.read_csv(os.path.join(SOURCE_DIR, filename), schema_overrides=DATASET_SCHEMAS[filename])
+        copies = [df] + [df.with_columns(pl.col(keys) + f"-{k}") for k in range(1, scale if keys else 1)]
+        df = pl.concat(copies)
+        write_dataset(df, filename)
+        rows += df.height
+    return rows
+
+
+def order_lines_inputs(today):
+    """The orders, product ids and customer ids generate_order_lines draws from, as the pipeline prepares them."""
+    orders = read_dataset("orders.csv", columns=ORDER_LINES_READS["orders.csv"])
+    product_ids = read_dataset("product.csv", columns=ORDER_LINES_READS["product.csv"])["product_id"]
+    customer_ids = read_dataset("customer.csv", columns=ORDER_LINES_READS["customer.csv"])["customer_id"]
+    orders = orders.with_columns(
+        random_choice(customer_ids, orders.height, day_rng("orders.csv:customer_id", today)).alias("customer_id")
+    )
+    return orders, product_ids, customer_ids
+
+
+def prepare_case(stage, scale, from_date, today):
+    """
+    Load what a stage needs outside the timed section. Returns (rows_in,
+    bytes_read, run) where run() performs the stage and returns rows out.
+    """
+    if stage == "write_dataset":
+        if os.getenv("USE_S3", "false").lower() == "true":
+            get_s3_client().create_bucket(Bucket=os.getenv("AWS_S3_BUCKET"))
+        return 0, 0, lambda: build_fixture(scale)
+
+    if stage == "read_dataset":
+        filenames = list(FIXTURE_KEYS)
+        keys = [k for f in filenames for k in list_dataset_parts(f)]
+        return 0, storage_bytes(keys), lambda: sum(read_dataset(f).height for f in filenames)
+
+    orders, product_ids, customer_ids = order_lines_inputs(today)
+    allocator = IdAllocator("order_lines.csv")
+    if stage == "generate_order_lines":
+        return orders.height, 0, lambda: generate_order_lines(
+            from_date, today, orders, product_ids, customer_ids, allocator=allocator
+        ).height
+
+    order_lines = generate_order_lines(from_date, today, orders, product_ids, customer_ids, allocator=allocator)
+    if stage == "update_dataset":
+        # Build the key indexes validation checks against once, outside the timed section.
+        for filename in ["order_lines.csv", *FOREIGN_KEYS["order_lines.csv"].values()]:
+            reference_keys(filename)
+
+        def run():
+            update_dataset("order_lines.csv", order_lines, allocator)
+            return order_lines.height
+        return order_lines.height, 0, run
+
+    if stage == "generate_returns":
+        order_lines = order_lines.select(RETURNS_READS["order_lines.csv"]).with_columns(
+            pl.col("order_date").str.strptime(pl.Date, "%Y-%m-%d %H:%M:%S%.3f").alias("order_date_parsed")
+        )
+        order_ids = read_dataset("orders.csv", columns=RETURNS_READS["orders.csv"])["order_id"]
+        returns_allocator = IdAllocator("returns.csv")
+        return order_lines.height, 0, lambda: generate_returns(
+            from_date, today, order_lines, product_ids, order_ids, customer_ids, allocator=returns_allocator
+        ).height
+
+    raise ValueError(f"Unknown benchmark stage: {stage}")
+
+
+def run_case(stage, scale, days):
+    """Run one stage against the fixture configured in the environment and measure it."""
+    today = datetime.date.today()
+    rows_in, bytes_read, run = prepare_case(stage, scale, today - datetime.timedelta(days=days), today)
+    stored_before = storage_bytes()
+    start = time.perf_counter()
+    rows_out = run()
+    wall = time.perf_counter() - start
+    return {
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        "wall_s": round(wall, 4),
+        "rows_per_s": round(rows_out / wall, 1) if wall > 0 else None,
+        "peak_rss_bytes": peak_rss(),
+        "bytes_read": bytes_read,
+        "bytes_written": max(storage_bytes() - stored_before, 0),
+    }
+
+
+def get_version():
+    """Short git commit of the benchmarked code, so results can be compared between versions."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_s3_stand_in():
+    """
+    Return (endpoint, server) for the S3 backend: S3_ENDPOINT_URL if set (e.g.
+    a MinIO container), else an in-process moto server (server is None when
+    an external endpoint is used). Returns (None, None) if neither is available.
+    """
+    if os.getenv("S3_ENDPOINT_URL"):
+        return os.getenv("S3_ENDPOINT_URL"), None
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        return None, None
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return f"http://{host}:{port}", server
+
+
+def run_child(stage, scale, days, env):
+    """Run one stage in a fresh interpreter, so peak RSS covers that stage alone; returns its measurements."""
+    result = subprocess.run(
+        [sys.executable, os.path.realpath(__file__), "--case", stage, "--scales", str(scale), "--days", str(days)],
+        env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark stage {stage} at {scale}x failed:\n{result.stdout[-2000:]}{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(scales, backends, stages, days, output):
+    """Run every stage at every scale on every backend and write one JSON line per measurement to output."""
+    base = {
+        "version": get_version(),
+        "storage_format": os.getenv("STORAGE_FORMAT", "csv").lower(),
+        "days": days,
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    for backend in backends:
+        server = None
+        env = dict(os.environ, GENERATION_SEED=os.getenv("GENERATION_SEED", "42"), USE_S3="false")
+        if backend == "s3":
+            endpoint, server = start_s3_stand_in()
+            if endpoint is None:
+                print("⚠️ No S3 stand-in (set S3_ENDPOINT_URL or install moto). Skipping the s3 backend.", file=sys.stderr)
+                continue
+            env.update(USE_S3="true", S3_ENDPOINT_URL=endpoint)
+            env.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+            env.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+        try:
+            for scale in scales:
+                with tempfile.TemporaryDirectory(prefix=f"benchmark-{scale}x-") as fixture_dir:
+                    env.update(DATA_DIR=fixture_dir, AWS_S3_BUCKET=f"demo-data-benchmark-{scale}x-{os.getpid()}")
+                    for stage in stages:
+                        print(f"⏱️ {backend} {scale}x {stage}", file=sys.stderr)
+                        record = dict(base, backend=backend, scale=scale, stage=stage)
+                        record.update(run_child(stage, scale, days, env))
+                        output.write(json.dumps(record) + "\n")
+                        output.flush()
+                if server is not None:
+                    # Drop the stand-in's objects so the next scale does not hold them in memory.
+                    urllib.request.urlopen(urllib.request.Request(f"{env['S3_ENDPOINT_URL']}/moto-api/reset", method="POST"))
+        finally:
+            if server is not None:
+                server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generators and I/O paths on scaled fixtures.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="Fixture sizes as multiples of the checked-in data (default: 1 10 100).")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS,
+                        help="Storage backends to run against (default: local s3).")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="Stages to measure (write_dataset builds the fixture and always runs first).")
+    parser.add_argument("--days", type=int, default=7, help="Days of order lines and returns to generate (default: 7).")
+    parser.add_argument("--output", help="Append JSON lines here instead of printing them.")
+    parser.add_argument("--case", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.scales[0], args.days)))
+    else:
+        stages = ["write_dataset"] + [s for s in STAGES if s in args.stages and s != "write_dataset"]
+        if args.output:
+            with open(args.output, "a") as f:
+                run_benchmarks(args.scales, args.backends, stages, args.days, f)
+        else:
+            run_benchmarks(args.scales, args.backends, stages, args.days, sys.stdout)
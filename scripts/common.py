@@ -1,112 +1,1649 @@
+import atexit
+import contextlib
 import datetime
+import json
 import os
-import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+import numpy as np
 import polars as pl
 
-# Base directory for your CSV files.
-DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "data")
+# Base directory for your CSV files (DATA_DIR overrides it, e.g. for benchmark fixtures).
+DATA_DIR = os.getenv("DATA_DIR") or os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "data")
 # Base date for numeric increments.
 base_date_incr = datetime.date(2022, 1, 1)
+# Bytes fetched from S3 to infer a dataset's header and column types.
+SCHEMA_PROBE_BYTES = 1024 * 1024
+# Merchant (workspace) identifiers every dataset is split by.
+MERCHANT_TYPES = ["merchant__electronics", "merchant__clothing", "merchant__bigboxretailer"]
 
-def generate_id(prefix):
-    """Generate a unique ID using a random number between 10^7 and 10^10-1."""
-    return f"{prefix}-{random.randint(10000000, 9999999999)}"
+# Explicit column types per dataset, shared by the CSV and Parquet backends so
+# neither has to infer them. Dates keep their CSV string formats.
+DATASET_SCHEMAS = {
+    "customer.csv": {
+        "customer_id": pl.Utf8,
+        "ls__customer_id__customer_name": pl.Utf8,
+        "customer_city": pl.Utf8,
+        "geo__customer_city__city_pushpin_longitude": pl.Float64,
+        "geo__customer_city__city_pushpin_latitude": pl.Float64,
+        "customer_country": pl.Utf8,
+        "customer_email": pl.Utf8,
+        "customer_state": pl.Utf8,
+        "customer_created_date": pl.Utf8,
+        "wdf__client_id": pl.Utf8,
+    },
+    "orders.csv": {
+        "order_id": pl.Utf8,
+        "wdf__client_id": pl.Utf8,
+        "order_status": pl.Utf8,
+    },
+    "order_lines.csv": {
+        "order_line_id": pl.Utf8,
+        "order__order_id": pl.Utf8,
+        "product__product_id": pl.Utf8,
+        "customer__customer_id": pl.Utf8,
+        "order_unit_price": pl.Float64,
+        "order_unit_quantity": pl.Float64,
+        "wdf__client_id": pl.Utf8,
+        "order_unit_discount": pl.Float64,
+        "order_unit_cost": pl.Float64,
+        "date": pl.Utf8,
+        "order_date": pl.Utf8,
+        "customer_age": pl.Utf8,
+    },
+    "returns.csv": {
+        "return_id": pl.Utf8,
+        "order__order_id": pl.Utf8,
+        "product__product_id": pl.Utf8,
+        "customer__customer_id": pl.Utf8,
+        "return_unit_cost": pl.Float64,
+        "return_unit_quantity": pl.Float64,
+        "wdf__client_id": pl.Utf8,
+        "return_unit_paid_amount": pl.Float64,
+        "date": pl.Utf8,
+        "return_date": pl.Utf8,
+    },
+    "monthly_inventory.csv": {
+        "monthly_inventory_id": pl.Utf8,
+        "product__product_id": pl.Utf8,
+        "inventory_month": pl.Utf8,
+        "monthly_quantity_eom": pl.Float64,
+        "wdf__client_id": pl.Utf8,
+        "monthly_quantity_bom": pl.Float64,
+        "date": pl.Utf8,
+    },
+    "product.csv": {
+        "product_id": pl.Utf8,
+        "ls__product_id__product_name": pl.Utf8,
+        "ls__product_id__product_id_image_web": pl.Utf8,
+        "product_brand": pl.Utf8,
+        "product_category": pl.Utf8,
+        "product_image": pl.Utf8,
+        "ls__product_image__product_image_web": pl.Utf8,
+        "rating": pl.Float64,
+        "product_rating": pl.Utf8,
+        "wdf__product_category": pl.Utf8,
+    },
+}
+# Column whose day (first 10 characters) names the Parquet date=YYYY-MM-DD partition.
+PARTITION_COLUMNS = {
+    "customer.csv": "customer_created_date",
+    "order_lines.csv": "order_date",
+    "returns.csv": "return_date",
+    "monthly_inventory.csv": "inventory_month",
+}
+# Column whose latest day is a dataset's watermark (resume point) in its manifest.
+# orders.csv only has order_date on freshly generated rows.
+WATERMARK_COLUMNS = {**PARTITION_COLUMNS, "orders.csv": "order_date"}
+# Prefix (local directory under DATA_DIR, or S3 key prefix) holding dataset manifests.
+MANIFEST_PREFIX = "manifests/"
+# Prefix holding per-update delta files listed in the manifests (EXPORT_DELTAS=true).
+DELTA_PREFIX = "deltas/"
+# Prefix holding full CSV rewrites until their commit promotes them over the live file.
+STAGING_PREFIX = "_staging/"
+# ID column (always the first column) and prefix of every generated dataset.
+ID_COLUMNS = {
+    "customer.csv": ("customer_id", "C"),
+    "orders.csv": ("order_id", "O"),
+    "order_lines.csv": ("order_line_id", "L"),
+    "returns.csv": ("return_id", "R"),
+    "monthly_inventory.csv": ("monthly_inventory_id", "M"),
+}
+# Legacy random IDs are prefix-<8 base36 characters>. Allocated IDs are longer
+# (9 base36 characters, or at least 11 decimal digits), so the two never collide.
+ID_BASE36_WIDTH = 9
+# First counter per ID_ENCODING.
+ID_START = {"base36": 0, "decimal": 10 ** 10}
+# Primary key of every dataset with a persisted key index (indexes/<stem>/).
+PRIMARY_KEYS = {**{filename: column for filename, (column, _) in ID_COLUMNS.items()}, "product.csv": "product_id"}
+# Columns of new rows that must reference an existing key of another dataset.
+FOREIGN_KEYS = {
+    "order_lines.csv": {
+        "order__order_id": "orders.csv",
+        "customer__customer_id": "customer.csv",
+        "product__product_id": "product.csv",
+    },
+    "returns.csv": {
+        "order__order_id": "orders.csv",
+        "customer__customer_id": "customer.csv",
+        "product__product_id": "product.csv",
+    },
+    "monthly_inventory.csv": {"product__product_id": "product.csv"},
+}
+# Prefix holding the key index parts listed in the manifests.
+KEY_INDEX_PREFIX = "indexes/"
+# Key index parts merged into one once a dataset has more.
+KEY_INDEX_MAX_PARTS = 16
+# Prefix holding rows rejected by validation (VALIDATION_MODE=quarantine).
+QUARANTINE_PREFIX = "quarantine/"
+# First delay between attempts of an object upload; doubled per retry.
+UPLOAD_RETRY_SECONDS = 0.5
+# S3 error codes worth retrying even though they are not 5xx responses.
+RETRYABLE_ERROR_CODES = {"RequestTimeout", "SlowDown", "Throttling", "ThrottlingException", "RequestTimeTooSkewed"}
+ID_BASE36_DIGITS = np.array(list("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+# Seconds between resident-memory samples while a stage is measured.
+RSS_SAMPLE_SECONDS = 0.05
+# OpenMetrics counter families rendered from stage records: (family, record field, unit).
+METRIC_COUNTERS = [
+    ("demo_data_stage_duration_seconds", "duration_s", "seconds"),
+    ("demo_data_stage_rows_in", "rows_in", None),
+    ("demo_data_stage_rows_out", "rows_out", None),
+    ("demo_data_stage_read_bytes", "bytes_read", "bytes"),
+    ("demo_data_stage_written_bytes", "bytes_written", "bytes"),
+    ("demo_data_stage_rows_rejected", "rows_rejected", None),
+]
+
+def get_rng():
+    """Return a NumPy random generator used for column-wise sampling."""
+    return np.random.default_rng()
+
+def get_seed():
+    """Return GENERATION_SEED as an int, or None for non-reproducible runs."""
+    seed = os.getenv("GENERATION_SEED")
+    return int(seed) if seed not in (None, "") else None
+
+def get_scale_factor():
+    """Return SCALE_FACTOR (default 1), the multiplier for the daily customer and order volumes."""
+    factor = float(os.getenv("SCALE_FACTOR", "1"))
+    if factor <= 0:
+        raise ValueError(f"SCALE_FACTOR must be positive: {factor}")
+    return factor
+
+def scale_range(volume_range):
+    """Scale a (low, high) per-day row count range by SCALE_FACTOR, rounded to whole rows."""
+    factor = get_scale_factor()
+    return tuple(int(round(v * factor)) for v in volume_range)
+
+def day_rng(dataset, day):
+    """Return the RNG stream of one dataset and day, derived from GENERATION_SEED when set."""
+    seed = get_seed()
+    if seed is None:
+        return get_rng()
+    return np.random.default_rng(np.random.SeedSequence([seed, zlib.crc32(dataset.encode("utf-8")), day.toordinal()]))
+
+_snapshot_frames = {}
+_snapshot_lock = threading.Lock()
+
+class Snapshot:
+    """Picklable handle to a reference table written once per run as Arrow IPC and memory-mapped by each process."""
+
+    def __init__(self, path, column=None):
+        self.path = path
+        self.column = column
+
+    @classmethod
+    def write(cls, df, path):
+        """Write df as a snapshot file at path and return its handle."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.write_ipc(path, compression="uncompressed")
+        return cls(path)
+
+    def __getitem__(self, column):
+        return Snapshot(self.path, column)
+
+    def frame(self):
+        """The memory-mapped snapshot table."""
+        with _snapshot_lock:
+            if self.path not in _snapshot_frames:
+                # Polars memory-maps uncompressed local IPC files (memory_map defaults to True).
+                _snapshot_frames[self.path] = pl.read_ipc(self.path)
+            return _snapshot_frames[self.path]
+
+    def series(self):
+        return self.frame()[self.column]
+
+def release_snapshots(snapshot_dir):
+    """Forget this process's mappings of the snapshots under snapshot_dir (before it is removed)."""
+    with _snapshot_lock:
+        for path in [p for p in _snapshot_frames if p.startswith(snapshot_dir)]:
+            del _snapshot_frames[path]
+
+def as_series(values):
+    """Return values (a Series, Snapshot column, list or set) as a Series without copying Series input."""
+    if isinstance(values, pl.Series):
+        return values
+    if isinstance(values, Snapshot):
+        return values.series()
+    return pl.Series(list(values) if isinstance(values, (set, frozenset)) else values)
+
+def as_frame(values):
+    """Return values (a DataFrame, Snapshot or list of row dicts) as a DataFrame."""
+    if isinstance(values, pl.DataFrame):
+        return values
+    if isinstance(values, Snapshot):
+        return values.frame()
+    return pl.DataFrame(values)
+
+def random_choice(values, n, rng):
+    """Draw n values (with replacement) from a list or Series as a Series."""
+    values = as_series(values)
+    return values.gather(rng.integers(0, len(values), size=n))
+
+def random_amount(low, high, n, rng, incr=0.0):
+    """Draw n uniform amounts, shift them by incr and round to cents."""
+    return np.round(rng.uniform(low, high, size=n) + incr, 2)
+
+def date_column(day, n, fmt="%Y-%m-%d"):
+    """Return a Series repeating the formatted day n times."""
+    return pl.repeat(day.strftime(fmt), n, eager=True)
+
+def concat_frames(frames):
+    """Concatenate per-day frames, returning an empty frame when nothing was generated."""
+    return pl.concat(frames) if frames else pl.DataFrame()
+
+# Identifies the records of one process run in the metrics output.
+RUN_ID = uuid.uuid4().hex[:12]
+_metrics = []
+_metrics_written = 0
+_metrics_lock = threading.Lock()
+_active_stages = {}
+_rss_sampler = None
+_stage_stack = threading.local()
+
+def get_metrics_file():
+    """Return METRICS_FILE, where stage metrics are written at exit ("-" for stdout); None disables them."""
+    return os.getenv("METRICS_FILE") or None
+
+def get_metrics_format():
+    """Return METRICS_FORMAT: jsonl (one record per stage run, default) or openmetrics."""
+    fmt = os.getenv("METRICS_FORMAT", "jsonl").lower()
+    if fmt not in ("jsonl", "openmetrics"):
+        raise ValueError(f"Unsupported METRICS_FORMAT: {fmt}")
+    return fmt
+
+def current_rss():
+    """Resident memory of this process in bytes (the peak so far where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def _sample_rss():
+    global _rss_sampler
+    while True:
+        rss = current_rss()
+        with _metrics_lock:
+            if not _active_stages:
+                _rss_sampler = None
+                return
+            for record in _active_stages.values():
+                record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+        time.sleep(RSS_SAMPLE_SECONDS)
+
+@contextlib.contextmanager
+def measure_stage(stage, dataset=None):
+    """Record wall time, peak RSS, bytes and rows of one pipeline stage when METRICS_FILE is set."""
+    if get_metrics_file() is None:
+        yield {}
+        return
+    global _rss_sampler
+    stack = _stage_stack.__dict__.setdefault("records", [])
+    record = {
+        "run_id": RUN_ID,
+        "stage": stage,
+        "dataset": dataset or (stack[-1]["dataset"] if stack else None),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "status": "ok",
+        "duration_s": 0.0,
+        "rows_in": 0,
+        "rows_out": 0,
+        "rows_rejected": 0,
+        "bytes_read": 0,
+        "bytes_written": 0,
+        "peak_rss_bytes": current_rss(),
+    }
+    with _metrics_lock:
+        if not _metrics:
+            atexit.register(write_metrics)
+        _metrics.append(record)
+        _active_stages[id(record)] = record
+        if _rss_sampler is None:
+            _rss_sampler = threading.Thread(target=_sample_rss, name="rss-sampler", daemon=True)
+            _rss_sampler.start()
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        record["duration_s"] = round(time.perf_counter() - start, 6)
+        stack.pop()
+        if stack and stage == "read" and stack[-1]["stage"] == "generate":
+            stack[-1]["rows_in"] += record["rows_out"]
+        rss = current_rss()
+        with _metrics_lock:
+            del _active_stages[id(record)]
+            record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+
+def count_bytes(read=0, written=0):
+    """Add bytes read/written to every stage being measured on this thread."""
+    for record in getattr(_stage_stack, "records", []):
+        record["bytes_read"] += read
+        record["bytes_written"] += written
+
+def _label_value(value):
+    return str(value or "").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_openmetrics(records):
+    """Render stage records as an OpenMetrics text exposition per (stage, dataset)."""
+    totals = {}
+    for record in records:
+        key = (record["stage"], record["dataset"] or "")
+        total = totals.setdefault(key, {"runs": 0, "errors": 0, "peak_rss_bytes": 0})
+        total["runs"] += 1
+        total["errors"] += record["status"] != "ok"
+        total["peak_rss_bytes"] = max(total["peak_rss_bytes"], record["peak_rss_bytes"])
+        for _, field, _ in METRIC_COUNTERS:
+            total[field] = total.get(field, 0) + record[field]
+
+    def samples(name, field, suffix=""):
+        return [
+            f'{name}{suffix}{{stage="{_label_value(stage)}",dataset="{_label_value(dataset)}"}} {total[field]}'
+            for (stage, dataset), total in sorted(totals.items())
+        ]
+
+    lines = []
+    for name, field, unit in [("demo_data_stage_runs", "runs", None), ("demo_data_stage_errors", "errors", None)] + METRIC_COUNTERS:
+        lines.append(f"# TYPE {name} counter")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.extend(samples(name, field, "_total"))
+    lines += ["# TYPE demo_data_stage_peak_rss_bytes gauge", "# UNIT demo_data_stage_peak_rss_bytes bytes"]
+    lines.extend(samples("demo_data_stage_peak_rss_bytes", "peak_rss_bytes"))
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def write_metrics():
+    """Write this run's stage records to METRICS_FILE ("-" for stdout) as JSON lines or OpenMetrics."""
+    global _metrics_written
+    path = get_metrics_file()
+    with _metrics_lock:
+        records = [dict(r) for r in _metrics]
+        new_records = records[_metrics_written:]
+        _metrics_written = len(records)
+    if path is None or not records:
+        return
+    if get_metrics_format() == "openmetrics":
+        text = render_openmetrics(records)
+    else:
+        text = "".join(json.dumps(r) + "\n" for r in new_records)
+    if path == "-":
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    elif get_metrics_format() == "openmetrics":
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    else:
+        with open(path, "a") as f:
+            f.write(text)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_cache_lock = threading.Lock()
+# Cache entries this process has handed out; evict_cache never deletes them.
+_cache_pins = set()
+
+def get_s3_client():
+    """Return the process-wide S3 client, with a connection pool and retries configured from the environment."""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                config = Config(
+                    max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32")),
+                    retries={"max_attempts": int(os.getenv("S3_MAX_ATTEMPTS", "5")), "mode": "adaptive"},
+                    connect_timeout=10,
+                    read_timeout=60,
+                    tcp_keepalive=True,
+                )
+                _s3_client = boto3.client(
+                    "s3",
+                    region_name="us-east-1",
+                    endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                    aws_session_token=os.getenv("AWS_SESSION_TOKEN"),
+                    config=config,
+                )
+    return _s3_client
+
+def get_transfer_config():
+    """Return the multipart transfer settings (S3_MULTIPART_CHUNK_MB, S3_MAX_CONCURRENCY)."""
+    chunk_size = int(os.getenv("S3_MULTIPART_CHUNK_MB", "16")) * 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=chunk_size,
+        multipart_chunksize=chunk_size,
+        max_concurrency=int(os.getenv("S3_MAX_CONCURRENCY", "10")),
+        use_threads=True,
+    )
+
+def is_missing_object(error):
+    """Return True if a ClientError means the S3 object does not exist."""
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+def get_cache_limit():
+    """Size cap of the local S3 object cache in bytes (S3_CACHE_MB, default 2048; 0 disables the cache)."""
+    return int(float(os.getenv("S3_CACHE_MB", "2048")) * 1024 * 1024)
+
+def get_cache_dir():
+    """Directory of the local S3 object cache (S3_CACHE_DIR, default ~/.cache/demo_data), or None if disabled."""
+    if get_cache_limit() <= 0:
+        return None
+    return os.path.expanduser(os.getenv("S3_CACHE_DIR") or os.path.join("~", ".cache", "demo_data"))
+
+def read_cache_meta(path):
+    """Return the metadata (ETag, Arrow copy) of a cached object, or None if it is not cached."""
+    try:
+        with open(f"{path}.meta.json", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cache_file(path, write):
+    """Fill a cache file through a uniquely named temp file, so concurrent readers never see a partial copy."""
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_cache_meta(path, meta):
+    """Replace the metadata of a cached object."""
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+
+    write_cache_file(f"{path}.meta.json", write)
+
+def evict_cache():
+    """Delete the least recently used unpinned cache entries until the cache fits in S3_CACHE_MB."""
+    cache_dir = get_cache_dir()
+    with _cache_lock:
+        entries = []
+        for dirpath, _, files in os.walk(cache_dir):
+            for name in files:
+                if not name.endswith(".meta.json"):
+                    continue
+                path = os.path.join(dirpath, name[:-len(".meta.json")])
+                paths = [path, f"{path}.arrow", f"{path}.meta.json"]
+                try:
+                    size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+                    entries.append((os.path.getmtime(paths[-1]), path, paths, size))
+                except OSError:
+                    continue
+        total = sum(entry[3] for entry in entries)
+        for _, path, paths, size in sorted(entries):
+            if total <= get_cache_limit():
+                break
+            if path in _cache_pins:
+                continue
+            for p in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(p)
+            total -= size
+
+def fetch_cached(key):
+    """Return the path of an up-to-date, pinned cache copy of an S3 object, revalidated by ETag."""
+    s3 = get_s3_client()
+    bucket = os.getenv("AWS_S3_BUCKET")
+    path = os.path.join(get_cache_dir(), bucket, *key.split("/"))
+    with _cache_lock:
+        _cache_pins.add(path)
+    meta = read_cache_meta(path)
+    conditions = {"IfNoneMatch": meta["etag"]} if meta is not None and os.path.exists(path) else {}
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key, **conditions)
+    except ClientError as e:
+        if conditions and e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+            # Mark the entry as recently used for LRU eviction.
+            os.utime(f"{path}.meta.json")
+            return path
+        raise
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if obj["ContentLength"] > get_transfer_config().multipart_threshold:
+        obj["Body"].close()
+        write_cache_file(path, lambda tmp_path: s3.download_file(bucket, key, tmp_path, Config=get_transfer_config()))
+    else:
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(obj["Body"], f)
+
+        write_cache_file(path, write)
+    count_bytes(read=os.path.getsize(path))
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(f"{path}.arrow")
+    write_cache_meta(path, {"etag": obj["ETag"]})
+    evict_cache()
+    return path
+
+def arrow_fingerprint(meta, read_kwargs):
+    """The Arrow copy of a cached CSV is only valid for the object version and parse options it was built from."""
+    return f"{meta.get('etag')}:{sorted(read_kwargs.items())!r}"
+
+def scan_cached_csv(key, **read_kwargs):
+    """Lazily scan an S3 CSV from its local cache copy (or its Arrow copy, if one matches read_kwargs)."""
+    path = fetch_cached(key)
+    meta = read_cache_meta(path) or {}
+    arrow_path = f"{path}.arrow"
+    if meta.get("arrow") == arrow_fingerprint(meta, read_kwargs) and os.path.exists(arrow_path):
+        return pl.scan_ipc(arrow_path)
+    return pl.scan_csv(path, **read_kwargs)
+
+def read_cached_frame(key, fmt="csv", **read_kwargs):
+    """Parse an S3 object from its cache copy, reusing a parsed Arrow copy of a CSV when S3_CACHE_ARROW=true."""
+    path = fetch_cached(key)
+    if fmt == "parquet":
+        return pl.read_parquet(path, **read_kwargs)
+    if os.getenv("S3_CACHE_ARROW", "true").lower() != "true":
+        return pl.read_csv(path, **read_kwargs)
+
+    meta = read_cache_meta(path) or {}
+    fingerprint = arrow_fingerprint(meta, read_kwargs)
+    arrow_path = f"{path}.arrow"
+    if meta.get("arrow") == fingerprint and os.path.exists(arrow_path):
+        return pl.read_ipc(arrow_path)
+    df = pl.read_csv(path, **read_kwargs)
+    write_cache_file(arrow_path, df.write_ipc)
+    write_cache_meta(path, dict(meta, arrow=fingerprint))
+    evict_cache()
+    return df
+
+def download_frame(key, fmt="csv", **read_kwargs):
+    """Fetch and parse an S3 object, through the local cache unless S3_CACHE_MB=0."""
+    if get_cache_dir() is not None:
+        return read_cached_frame(key, fmt, **read_kwargs)
+    s3 = get_s3_client()
+    bucket = os.getenv("AWS_S3_BUCKET")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, os.path.basename(key))
+        s3.download_file(bucket, key, path, Config=get_transfer_config())
+        count_bytes(read=os.path.getsize(path))
+        if fmt == "parquet":
+            return pl.read_parquet(path, **read_kwargs)
+        return pl.read_csv(path, **read_kwargs)
+
+def is_retryable(error):
+    """Return True if a failed upload may succeed when retried (network, throttling or 5xx errors)."""
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return status >= 500 or error.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return True
+
+def upload_file(path, key, content_type):
+    """Upload one local file to S3, retried up to S3_UPLOAD_RETRIES times with backoff."""
+    s3 = get_s3_client()
+    bucket = os.getenv("AWS_S3_BUCKET")
+    retries = int(os.getenv("S3_UPLOAD_RETRIES", "3"))
+    for attempt in range(retries + 1):
+        try:
+            s3.upload_file(path, bucket, key, ExtraArgs={"ContentType": content_type}, Config=get_transfer_config())
+            return
+        except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = UPLOAD_RETRY_SECONDS * 2 ** attempt
+            print(f"🔁 Upload of s3://{bucket}/{key} failed ({e}); retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def upload_frame(df, key, fmt="csv"):
+    """Serialize a frame and upload it to S3, or queue it on the active write-behind uploader."""
+    if _write_behind is not None:
+        _write_behind.submit(_upload_frame, df, key, fmt)
+        return
+    _upload_frame(df, key, fmt)
+
+def _upload_frame(df, key, fmt):
+    with measure_stage("upload") as record, tempfile.TemporaryDirectory() as tmp_dir:
+        record["rows_in"] = len(df)
+        path = os.path.join(tmp_dir, os.path.basename(key))
+        if fmt == "parquet":
+            df.write_parquet(path, compression=os.getenv("PARQUET_COMPRESSION", "zstd"))
+            content_type = "application/vnd.apache.parquet"
+        else:
+            df.write_csv(path)
+            content_type = "text/csv"
+        upload_file(path, key, content_type)
+        count_bytes(written=os.path.getsize(path))
+
+class WriteBehind:
+    """Uploads a batch's data objects in parallel and publishes its metadata only once they have all landed."""
+
+    def __init__(self, workers=None):
+        self.workers = workers or int(os.getenv("S3_UPLOAD_WORKERS", "8"))
+        self.manifests = {}
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload")
+        self._uploads = []
+        self._steps = {}
+        self._final_steps = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._uploads.append(self._pool.submit(fn, *args))
+
+    def publish(self, group, step, final=False):
+        with self._lock:
+            if final:
+                self._final_steps[group] = step
+            else:
+                self._steps.setdefault(group, []).append(step)
+
+    def wait(self):
+        """Barrier: block until every queued upload has landed; raises the first upload that failed for good."""
+        for future in self._uploads:
+            future.result()
+
+    def run_steps(self):
+        """Run the held-back metadata steps, one thread per group, each group's final step last."""
+        def run_group(group):
+            for step in self._steps.get(group, []) + [self._final_steps.get(group)]:
+                if step is not None:
+                    step()
+
+        groups = list(self._steps) + [g for g in self._final_steps if g not in self._steps]
+        for future in [self._pool.submit(run_group, group) for group in groups]:
+            future.result()
+
+    def close(self, cancel=False):
+        self._pool.shutdown(wait=True, cancel_futures=cancel)
+
+_write_behind = None
+
+@contextlib.contextmanager
+def write_behind():
+    """Send the S3 dataset writes made in the block through a WriteBehind uploader."""
+    global _write_behind
+    # A rewrite reads the committed dataset back, so it cannot build on commits still held in the batch.
+    if os.getenv("USE_S3", "false").lower() != "true" or get_write_mode() != "append" or _write_behind is not None:
+        yield None
+        return
+    uploader = WriteBehind()
+    _write_behind = uploader
+    try:
+        yield uploader
+        uploader.wait()
+    except BaseException:
+        _write_behind = None
+        uploader.close(cancel=True)
+        raise
+    _write_behind = None
+    try:
+        uploader.run_steps()
+    finally:
+        uploader.close()
+
+def publish(group, step, final=False):
+    """Run a metadata step now, or after the data uploads of an active write-behind batch (a final one only once, last)."""
+    if _write_behind is None:
+        step()
+    else:
+        _write_behind.publish(group, step, final)
+
+_dataset_locks = {}
+_dataset_locks_lock = threading.Lock()
+
+def dataset_lock(filename):
+    """Return the in-process lock that serialises commits and recovery of one dataset."""
+    with _dataset_locks_lock:
+        return _dataset_locks.setdefault(filename, threading.RLock())
+
+def replace_file(path, write):
+    """Write a local file atomically through a temp file that is fsynced and renamed over path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        write(tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    count_bytes(written=os.path.getsize(path))
+
+def get_write_mode():
+    """Return WRITE_MODE: "append" (default) writes only the new rows, "rewrite" rewrites the dataset."""
+    return os.getenv("WRITE_MODE", "append").lower()
+
+def dataset_prefix(filename):
+    """S3 prefix holding the appended part objects of a dataset (order_lines.csv -> order_lines/)."""
+    return f"{os.path.splitext(filename)[0]}/"
+
+def list_part_keys(s3, bucket, filename):
+    """List the part object keys appended for a dataset, oldest first."""
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=dataset_prefix(filename)):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".csv"))
+    return sorted(keys)
+
+def local_key(path):
+    """Key of a local file relative to DATA_DIR, as recorded in manifests."""
+    return os.path.relpath(path, DATA_DIR).replace(os.sep, "/")
+
+def committed_parts(filename, keys, fmt):
+    """Keep the part keys the dataset's manifest lists for format fmt (every key without a manifest)."""
+    manifest = read_manifest(filename)
+    if manifest is None:
+        return keys
+    if manifest.get("format") != fmt:
+        return []
+    parts = set(manifest["parts"])
+    return [k for k in keys if k in parts]
 
 def read_csv(filename):
-    """
-    Read a CSV file from local disk or from S3 if USE_S3=true is set.
-    """
+    """Read a CSV file from local disk or from S3 (base object plus appended parts) if USE_S3=true is set."""
     if os.getenv("USE_S3", "false").lower() == "true":
-        s3 = boto3.client(
-            "s3",
-            region_name="us-east-1",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            aws_session_token=os.getenv("AWS_SESSION_TOKEN")
-        )
+        s3 = get_s3_client()
         bucket = os.getenv("AWS_S3_BUCKET")
         key = filename
 
         print(f"📦 Reading {key} from s3://{bucket}/{key}...")
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        return pl.read_csv(BytesIO(obj["Body"].read()))
+        part_keys = committed_parts(filename, list_part_keys(s3, bucket, filename), "csv")
+        try:
+            frames = [download_frame(key, schema_overrides=DATASET_SCHEMAS.get(filename))]
+        except ClientError as e:
+            if not is_missing_object(e):
+                raise
+            if not part_keys:
+                raise FileNotFoundError(f"s3://{bucket}/{key} does not exist") from e
+            frames = []
+        for part_key in part_keys:
+            frames.append(download_frame(part_key, schema_overrides=DATASET_SCHEMAS.get(filename)))
+        return pl.concat(frames, how="vertical_relaxed")
 
     file_path = os.path.join(DATA_DIR, filename)
     print(f"📂 Reading {filename} from local: {file_path}")
-    return pl.read_csv(file_path)
+    count_bytes(read=os.path.getsize(file_path))
+    return pl.read_csv(file_path, schema_overrides=DATASET_SCHEMAS.get(filename))
+
+def scan_csv_s3(filename):
+    """Lazily scan a dataset's S3 CSV objects from their cache copies (eagerly with S3_CACHE_MB=0)."""
+    if get_cache_dir() is None:
+        return read_csv(filename).lazy()
+    s3 = get_s3_client()
+    bucket = os.getenv("AWS_S3_BUCKET")
+    print(f"📦 Scanning {filename} from s3://{bucket}/{filename}...")
+    part_keys = committed_parts(filename, list_part_keys(s3, bucket, filename), "csv")
+    frames = []
+    for key in [filename] + part_keys:
+        try:
+            frames.append(scan_cached_csv(key, schema_overrides=DATASET_SCHEMAS.get(filename)))
+        except ClientError as e:
+            if key != filename or not is_missing_object(e):
+                raise
+            if not part_keys:
+                raise FileNotFoundError(f"s3://{bucket}/{key} does not exist") from e
+    return pl.concat(frames, how="vertical_relaxed")
+
+def read_csv_schema(filename, infer_rows=100):
+    """Return the column schema of a dataset from its leading rows, or None if it does not exist yet."""
+    if os.getenv("USE_S3", "false").lower() == "true":
+        s3 = get_s3_client()
+        bucket = os.getenv("AWS_S3_BUCKET")
+        keys = [filename] + list_part_keys(s3, bucket, filename)
+        for key in keys:
+            try:
+                obj = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{SCHEMA_PROBE_BYTES - 1}")
+            except s3.exceptions.NoSuchKey:
+                continue
+            head = obj["Body"].read()
+            # Drop the trailing partial line of a truncated ranged read.
+            if len(head) == SCHEMA_PROBE_BYTES and b"\n" in head:
+                head = head[:head.rindex(b"\n") + 1]
+            return pl.read_csv(BytesIO(head), n_rows=infer_rows).schema
+        return None
+
+    file_path = os.path.join(DATA_DIR, filename)
+    if not os.path.exists(file_path):
+        return None
+    return pl.read_csv(file_path, n_rows=infer_rows).schema
+
+def stage_csv(df, filename):
+    """Write a full CSV under a unique staging name readers never look at; returns the staging key."""
+    key = f"{STAGING_PREFIX}{filename}.{uuid.uuid4().hex[:8]}"
+    if os.getenv("USE_S3", "false").lower() == "true":
+        print(f"📤 Staging full file at s3://{os.getenv('AWS_S3_BUCKET')}/{key}")
+        upload_frame(df, key)
+    else:
+        replace_file(os.path.join(DATA_DIR, key), df.write_csv)
+    return key
+
+def promote(staged_key, key):
+    """Move a staged file/object over key; does nothing if it was already promoted."""
+    if os.getenv("USE_S3", "false").lower() == "true":
+        s3 = get_s3_client()
+        bucket = os.getenv("AWS_S3_BUCKET")
+        try:
+            s3.copy({"Bucket": bucket, "Key": staged_key}, bucket, key, Config=get_transfer_config())
+        except ClientError as e:
+            if is_missing_object(e):
+                return
+            raise
+        s3.delete_object(Bucket=bucket, Key=staged_key)
+        return
+    staged_path = os.path.join(DATA_DIR, staged_key)
+    if os.path.exists(staged_path):
+        os.replace(staged_path, os.path.join(DATA_DIR, key))
 
 def write_csv(df, filename):
+    """Replace a dataset with one staged CSV; returns the dataset's file/object list."""
+    promote(stage_csv(df, filename), filename)
     if os.getenv("USE_S3", "false").lower() == "true":
-        s3 = boto3.client(
-            "s3",
-            region_name="us-east-1",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            aws_session_token=os.getenv("AWS_SESSION_TOKEN")
+        s3 = get_s3_client()
+        bucket = os.getenv("AWS_S3_BUCKET")
+        # The base object now holds every row, so previously appended parts are stale.
+        for part_key in list_part_keys(s3, bucket, filename):
+            s3.delete_object(Bucket=bucket, Key=part_key)
+    return [filename]
+
+def append_csv(df, filename):
+    """Append rows to a dataset's CSV (locally to the file, on S3 as a new part); returns the written keys."""
+    if os.getenv("USE_S3", "false").lower() == "true":
+        check_csv_header(df, filename)
+        bucket = os.getenv("AWS_S3_BUCKET")
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        key = f"{dataset_prefix(filename)}part-{stamp}-{uuid.uuid4().hex[:8]}.csv"
+
+        print(f"📤 Uploading {len(df)} appended rows to s3://{bucket}/{key}")
+        upload_frame(df, key)
+        return [key]
+
+    file_path = os.path.join(DATA_DIR, filename)
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        replace_file(file_path, df.write_csv)
+        return [filename]
+    check_csv_header(df, filename)
+    with open(file_path, "rb+") as f:
+        # Make sure the new rows start on their own line.
+        start = f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+        df.write_csv(f, include_header=False)
+        f.flush()
+        os.fsync(f.fileno())
+        count_bytes(written=f.tell() - start - 1)
+    return [filename]
+
+def check_csv_header(df, filename):
+    """Raise ValueError unless df has the columns of the existing CSV header, in the same order."""
+    schema = read_csv_schema(filename)
+    if schema is not None and list(schema) != df.columns:
+        raise ValueError(
+            f"Cannot append to {filename}: its header is {list(schema)} but the new rows have {df.columns}"
         )
+
+def compact_dataset(filename):
+    """Merge a dataset's appended S3 CSV parts or Parquet part files back together."""
+    if get_storage_format() != "parquet" and os.getenv("USE_S3", "false").lower() != "true":
+        return
+    df = read_dataset(filename)
+    write_dataset(df, filename, keep_key_index=True)
+    print(f"🗜️ Compacted {filename} ({len(df)} records).")
+
+def get_storage_format():
+    """Return the dataset storage format: "csv" (default) or "parquet" (STORAGE_FORMAT)."""
+    return os.getenv("STORAGE_FORMAT", "csv").lower()
+
+def partition_date(path):
+    """Return the YYYY-MM-DD of a date=YYYY-MM-DD partition path, or None if unpartitioned."""
+    for part in path.replace(os.sep, "/").split("/"):
+        if part.startswith("date="):
+            return part[len("date="):]
+    return None
+
+def list_parquet_parts(filename, date_range=None):
+    """List the committed Parquet part files of a dataset within the inclusive (start, end) date_range."""
+    if os.getenv("USE_S3", "false").lower() == "true":
+        s3 = get_s3_client()
         bucket = os.getenv("AWS_S3_BUCKET")
-        key = filename
+        paths = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=dataset_prefix(filename)):
+            paths.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".parquet"))
+        paths = committed_parts(filename, paths, "parquet")
+    else:
+        root = os.path.join(DATA_DIR, dataset_prefix(filename))
+        paths = []
+        for dirpath, _, files in os.walk(root):
+            paths.extend(os.path.join(dirpath, f) for f in files if f.endswith(".parquet"))
+        committed = set(committed_parts(filename, [local_key(p) for p in paths], "parquet"))
+        paths = [p for p in paths if local_key(p) in committed]
+
+    if date_range is not None:
+        start, end = (d.strftime("%Y-%m-%d") if d else None for d in date_range)
+        paths = [
+            p for p in paths
+            if partition_date(p) is None
+            or ((start is None or partition_date(p) >= start) and (end is None or partition_date(p) <= end))
+        ]
+    return sorted(paths)
+
+def filter_date_range(df, filename, date_range):
+    """Keep the rows whose partition column day lies in the inclusive (start, end) date_range."""
+    date_col = PARTITION_COLUMNS.get(filename)
+    if date_range is None or date_col is None:
+        return df
+    start, end = date_range
+    day = pl.col(date_col).str.slice(0, 10)
+    if start is not None:
+        df = df.filter(day >= start.strftime("%Y-%m-%d"))
+    if end is not None:
+        df = df.filter(day <= end.strftime("%Y-%m-%d"))
+    return df
 
-        buffer = BytesIO()
-        df.write_csv(buffer)
-        buffer.seek(0)
+def scan_parquet_dataset(filename, columns=None, date_range=None):
+    """Return a LazyFrame over the partitioned Parquet parts overlapping date_range."""
+    parts = list_parquet_parts(filename, date_range)
+    date_col = PARTITION_COLUMNS.get(filename)
+    read_columns = columns
+    if columns is not None and date_range is not None and date_col and date_col not in columns:
+        read_columns = list(columns) + [date_col]
+    schema = DATASET_SCHEMAS.get(filename)
+    if not parts:
+        if schema is None:
+            raise FileNotFoundError(f"No Parquet parts found for {filename}")
+        return pl.LazyFrame(schema=schema)
 
-        print(f"📤 Uploading full file to s3://{bucket}/{key}")
-        s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue(), ContentType="text/csv")
+    if os.getenv("USE_S3", "false").lower() == "true":
+        bucket = os.getenv("AWS_S3_BUCKET")
+        print(f"📦 Reading {len(parts)} Parquet parts of {filename} from s3://{bucket}/{dataset_prefix(filename)}")
+        frames = [download_frame(key, "parquet", columns=read_columns) for key in parts]
+        return pl.concat(frames, how="vertical_relaxed").lazy()
+
+    print(f"📂 Scanning {len(parts)} Parquet parts of {filename} from local: {dataset_prefix(filename)}")
+    count_bytes(read=sum(os.path.getsize(p) for p in parts))
+    return pl.scan_parquet(parts, hive_partitioning=False)
+
+def write_parquet_parts(df, filename):
+    """Write rows as new Parquet part files, one per date partition; returns the written keys."""
+    if df.is_empty():
+        return []
+    if filename in DATASET_SCHEMAS:
+        df = df.cast(DATASET_SCHEMAS[filename])
+    compression = os.getenv("PARQUET_COMPRESSION", "zstd")
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    part_name = f"part-{stamp}-{uuid.uuid4().hex[:8]}.parquet"
+    date_col = PARTITION_COLUMNS.get(filename)
+    if date_col is None:
+        groups = [(None, df)]
+    else:
+        groups = df.with_columns(pl.col(date_col).str.slice(0, 10).alias("__partition")).partition_by(
+            "__partition", as_dict=True, include_key=False, maintain_order=True
+        ).items()
+        groups = [(key[0], group) for key, group in groups]
+
+    use_s3 = os.getenv("USE_S3", "false").lower() == "true"
+    keys = []
+    for day, group in groups:
+        rel_key = dataset_prefix(filename) + (f"date={day}/" if day else "") + part_name
+        if use_s3:
+            upload_frame(group, rel_key, "parquet")
+        else:
+            replace_file(os.path.join(DATA_DIR, rel_key),
+                         lambda path: group.write_parquet(path, compression=compression))
+        keys.append(rel_key)
+    print(f"📤 Wrote {len(df)} rows of {filename} as {len(groups)} Parquet part(s)")
+    return keys
+
+def scan_dataset(filename, columns=None, date_range=None):
+    """Lazily scan a dataset's committed data, parsing only the given columns (a generator's READS) and date_range."""
+    recover_dataset(filename)
+    if get_storage_format() == "parquet" and list_parquet_parts(filename):
+        lf = scan_parquet_dataset(filename, columns, date_range)
+    elif os.getenv("USE_S3", "false").lower() == "true":
+        lf = scan_csv_s3(filename)
     else:
         file_path = os.path.join(DATA_DIR, filename)
-        df.write_csv(file_path)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"{file_path} does not exist")
+        print(f"📂 Scanning {filename} from local: {file_path}")
+        count_bytes(read=os.path.getsize(file_path))
+        lf = pl.scan_csv(file_path, schema_overrides=DATASET_SCHEMAS.get(filename))
+    return select_columns(filter_date_range(lf, filename, date_range), columns)
+
+def select_columns(df, columns=None):
+    """Project a DataFrame or LazyFrame onto columns (all columns if None)."""
+    return df.select(columns) if columns is not None else df
+
+def collect(lf):
+    """Collect a LazyFrame with Polars' streaming engine, which keeps peak memory bounded on large scans."""
+    return lf.collect(engine="streaming")
+
+def read_dataset(filename, columns=None, date_range=None):
+    """Read a dataset in the configured storage format, optionally projecting columns and a date_range."""
+    with measure_stage("read", filename) as record:
+        df = collect(scan_dataset(filename, columns, date_range))
+        record["rows_out"] = len(df)
+    return df
+
+def stage_dataset(df, filename, manifest):
+    """Write df as a dataset's full new contents, invisible until manifest is committed."""
+    if get_storage_format() == "parquet":
+        manifest["parts"] = write_parquet_parts(df, filename)
+    else:
+        manifest["parts"] = [filename]
+        manifest["pending"] = [[stage_csv(df, filename), filename]]
+    manifest["row_count"] = len(df)
+    manifest["format"] = get_storage_format()
 
-def update_dataset(filename, new_data):
-    df_orig = read_csv(filename)
-    df_new = pl.DataFrame(new_data)
-    ref_columns = df_orig.columns
-    for col in ref_columns:
+def write_dataset(df, filename, keep_key_index=False):
+    """Replace a dataset's rows with df as one commit (keep_key_index: same rows, as when compacting); returns its parts."""
+    with dataset_lock(filename):
+        recover_dataset(filename)
+        manifest = load_manifest(filename)
+        if not keep_key_index:
+            manifest.pop("key_index", None)
+            manifest["last_date"] = max_watermark(df, filename)
+        stage_dataset(df, filename, manifest)
+        commit_manifest(filename, manifest)
+    return manifest["parts"]
+
+def append_dataset(df, filename):
+    """Append rows in the configured storage format (migrating CSV history on the first Parquet append)."""
+    if get_storage_format() == "parquet":
+        keys = []
+        if not list_parquet_parts(filename) and read_csv_schema(filename) is not None:
+            print(f"🔁 Migrating {filename} from CSV to Parquet")
+            keys = write_parquet_parts(align_to_schema(read_csv(filename), dataset_schema(filename)), filename)
+        return keys + write_parquet_parts(df, filename)
+    return append_csv(df, filename)
+
+def export_csv(filename):
+    """Export a Parquet dataset as a single CSV (the public raw file) next to it."""
+    df = read_dataset(filename)
+    write_csv(df, filename)
+    print(f"📄 Exported {len(df)} records of {filename} to CSV")
+
+def dataset_schema(filename):
+    """Return the schema new rows are aligned to (DATASET_SCHEMAS, else the CSV header, else None)."""
+    if filename in DATASET_SCHEMAS:
+        return pl.Schema(DATASET_SCHEMAS[filename])
+    return read_csv_schema(filename)
+
+def align_to_schema(df_new, schema):
+    """Select and order df_new's columns to match schema, adding missing ones as nulls."""
+    for col, dtype in schema.items():
         if col not in df_new.columns:
-            dtype = df_orig.schema.get(col, pl.Utf8)
             df_new = df_new.with_columns(pl.lit(None).cast(dtype).alias(col))
-    df_new = df_new.select(ref_columns)
-    updated_df = pl.concat([df_orig, df_new])
-    write_csv(updated_df, filename)
-    print(f"✅ Updated {filename} with {len(new_data)} new records.")
+    return df_new.select(list(schema.keys()))
 
-def write_deltas_to_s3(df, filename):
-    if df.is_empty():
-        print(f"⚠️ No delta data to upload for {filename}. Skipping.")
+def manifest_key(filename):
+    """Key of a dataset's manifest (manifests/order_lines.json for order_lines.csv)."""
+    return f"{MANIFEST_PREFIX}{os.path.splitext(filename)[0]}.json"
+
+def read_manifest(filename):
+    """Return a dataset's manifest dict, or None if it has none yet."""
+    key = manifest_key(filename)
+    if os.getenv("USE_S3", "false").lower() == "true":
+        s3 = get_s3_client()
+        bucket = os.getenv("AWS_S3_BUCKET")
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if is_missing_object(e):
+                return None
+            raise
+        return json.loads(obj["Body"].read())
+
+    file_path = os.path.join(DATA_DIR, key)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r") as f:
+        return json.load(f)
+
+def write_manifest(filename, manifest):
+    """Persist a dataset's manifest atomically."""
+    manifest["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    body = json.dumps(manifest, indent=2)
+    key = manifest_key(filename)
+    with measure_stage("meta_update", filename):
+        if os.getenv("USE_S3", "false").lower() == "true":
+            s3 = get_s3_client()
+            bucket = os.getenv("AWS_S3_BUCKET")
+            s3.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"), ContentType="application/json")
+            count_bytes(written=len(body.encode("utf-8")))
+            return
+
+        def write(path):
+            with open(path, "w") as f:
+                f.write(body)
+
+        replace_file(os.path.join(DATA_DIR, key), write)
+
+def commit_manifest(filename, manifest):
+    """Commit a dataset's staged data by writing its manifest, then promote staged files and drop unlisted parts."""
+    if _write_behind is not None:
+        _write_behind.manifests[filename] = manifest
+        _write_behind.publish(filename, lambda: commit_manifest(filename, manifest))
         return
+    with dataset_lock(filename):
+        manifest.pop("append_from", None)
+        if manifest["format"] == "csv" and os.getenv("USE_S3", "false").lower() != "true":
+            staged = dict((key, staged_key) for staged_key, key in manifest.get("pending", []))
+            file_path = os.path.join(DATA_DIR, staged.get(filename, filename))
+            if os.path.exists(file_path):
+                manifest["size"] = os.path.getsize(file_path)
+        else:
+            manifest.pop("size", None)
+        write_manifest(filename, manifest)
+        if manifest.get("pending"):
+            apply_pending(filename, manifest)
+        remove_uncommitted_parts(filename, manifest)
 
-    s3 = boto3.client(
-        "s3",
-        region_name="us-east-1",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        aws_session_token=os.getenv("AWS_SESSION_TOKEN")
-    )
-    bucket = os.getenv("AWS_S3_BUCKET")
-    key = f"deltas/{filename}"
+def apply_pending(filename, manifest):
+    """Promote the staged files of a committed manifest and record that they are in place."""
+    for staged_key, key in manifest["pending"]:
+        promote(staged_key, key)
+    del manifest["pending"]
+    write_manifest(filename, manifest)
+
+def remove_uncommitted_parts(filename, manifest):
+    """Delete a dataset's parts, key index parts and staging files the manifest does not list."""
+    ext = ".parquet" if manifest["format"] == "parquet" else ".csv"
+    keep = set(manifest["parts"]) | set(staged_key for staged_key, _ in manifest.get("pending", []))
+    keep |= set(manifest.get("key_index", []))
+    staging = f"{STAGING_PREFIX}{filename}."
+    # Part prefix -> extension of the parts it holds.
+    prefixes = {dataset_prefix(filename): ext, key_index_prefix(filename): ".parquet"}
+    if os.getenv("USE_S3", "false").lower() == "true":
+        s3 = get_s3_client()
+        bucket = os.getenv("AWS_S3_BUCKET")
+        paginator = s3.get_paginator("list_objects_v2")
+        for prefix in list(prefixes) + [staging]:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    key = obj["Key"]
+                    if key not in keep and (key.startswith(staging) or key.endswith(prefixes.get(prefix, ""))):
+                        s3.delete_object(Bucket=bucket, Key=key)
+        return
 
-    buffer = BytesIO()
-    df.write_csv(buffer)
-    buffer.seek(0)
+    stale = []
+    for prefix, prefix_ext in prefixes.items():
+        for dirpath, _, files in os.walk(os.path.join(DATA_DIR, prefix)):
+            stale.extend(
+                os.path.join(dirpath, f) for f in files
+                if f.endswith(".tmp") or (f.endswith(prefix_ext) and local_key(os.path.join(dirpath, f)) not in keep)
+            )
+    staging_dir = os.path.join(DATA_DIR, STAGING_PREFIX)
+    if os.path.isdir(staging_dir):
+        stale.extend(
+            os.path.join(staging_dir, f) for f in os.listdir(staging_dir)
+            if f.startswith(f"{filename}.") and f"{STAGING_PREFIX}{f}" not in keep
+        )
+    for path in stale:
+        os.remove(path)
+
+_rebuilding = set()
+
+def recover_dataset(filename):
+    """Bring a dataset back to its last commit after a crash or an edit outside the pipeline."""
+    with dataset_lock(filename):
+        manifest = None if filename in _rebuilding else read_manifest(filename)
+        if manifest is None:
+            return
+        if manifest.get("pending"):
+            print(f"🩹 Completing the interrupted commit of {filename}")
+            apply_pending(filename, manifest)
+        file_path = os.path.join(DATA_DIR, filename)
+        if manifest["format"] != "csv" or os.getenv("USE_S3", "false").lower() == "true":
+            return
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else None
+        start = manifest.pop("append_from", None)
+        if start is not None:
+            if size is not None and size > start:
+                print(f"🩹 Dropping {size - start} uncommitted bytes from {filename}")
+                with open(file_path, "rb+") as f:
+                    f.truncate(start)
+                    os.fsync(f.fileno())
+                if start == 0:
+                    os.remove(file_path)
+            write_manifest(filename, manifest)
+        elif manifest.get("size") is not None and size != manifest["size"]:
+            print(f"🧭 {filename} changed outside the pipeline. Rebuilding its manifest")
+            rebuild_manifest(filename, manifest)
+
+def rebuild_manifest(filename, manifest):
+    """Replace a stale manifest with one built from the data, keeping its ID counter and deltas."""
+    _rebuilding.add(filename)
+    try:
+        fresh = build_manifest(filename)
+    finally:
+        _rebuilding.discard(filename)
+    if "deltas" in manifest:
+        fresh["deltas"] = manifest["deltas"]
+    next_id = max(fresh.get("next_id", 0), manifest.get("next_id", 0))
+    if next_id:
+        fresh["next_id"] = next_id
+    with _key_indexes_lock:
+        _key_indexes.pop(filename, None)
+    commit_manifest(filename, fresh)
+
+def list_dataset_parts(filename):
+    """List the files/objects currently making up a dataset (relative keys)."""
+    if get_storage_format() == "parquet" and list_parquet_parts(filename):
+        parts = list_parquet_parts(filename)
+        if os.getenv("USE_S3", "false").lower() == "true":
+            return parts
+        return [local_key(p) for p in parts]
+    if os.getenv("USE_S3", "false").lower() == "true":
+        part_keys = list_part_keys(get_s3_client(), os.getenv("AWS_S3_BUCKET"), filename)
+        return [filename] + committed_parts(filename, part_keys, "csv")
+    return [filename] if os.path.exists(os.path.join(DATA_DIR, filename)) else []
+
+def max_watermark(df, filename):
+    """Return the latest watermark day (YYYY-MM-DD) among df's rows, or None."""
+    date_col = WATERMARK_COLUMNS.get(filename)
+    if date_col is None or date_col not in df.columns or df.is_empty():
+        return None
+    return df.select(pl.col(date_col).cast(pl.Utf8).str.slice(0, 10).max()).item()
+
+def load_manifest(filename):
+    """Return a dataset's manifest, building it from one scan of the dataset the first time."""
+    if _write_behind is not None and filename in _write_behind.manifests:
+        return _write_behind.manifests[filename]
+    manifest = read_manifest(filename)
+    if manifest is not None:
+        return manifest
+    manifest = build_manifest(filename)
+    commit_manifest(filename, manifest)
+    return manifest
+
+def build_manifest(filename):
+    """Build a dataset's manifest from one scan of its data."""
+    print(f"🧭 Building manifest for {filename} from a one-time scan")
+    schema = dataset_schema(filename)
+    date_col = WATERMARK_COLUMNS.get(filename)
+    id_col = ID_COLUMNS.get(filename, (None, None))[0]
+    columns = [c for c in (date_col, id_col) if schema is not None and c in schema]
+    try:
+        df = read_dataset(filename, columns=columns or None)
+        last_date = max_watermark(df, filename)
+        row_count = len(df)
+        next_id = next_allocated_id(df[id_col]) if id_col in df.columns else 0
+    except (FileNotFoundError, ClientError) as e:
+        if isinstance(e, ClientError) and not is_missing_object(e):
+            raise
+        last_date, row_count, next_id = None, 0, 0
+    parts = list_dataset_parts(filename)
+    manifest = {
+        "dataset": filename,
+        "format": "parquet" if any(p.endswith(".parquet") for p in parts) else "csv",
+        "last_date": last_date,
+        "row_count": row_count,
+        "schema": {col: str(dtype) for col, dtype in schema.items()} if schema is not None else {},
+        "parts": parts,
+    }
+    if next_id:
+        manifest["next_id"] = next_id
+    return manifest
+
+def get_id_encoding():
+    """Return ID_ENCODING: base36 (compact X-XXXXXXXXX, default) or decimal."""
+    encoding = os.getenv("ID_ENCODING", "base36").lower()
+    if encoding not in ID_START:
+        raise ValueError(f"Unsupported ID_ENCODING: {encoding}")
+    return encoding
+
+def encode_ids(prefix, counters, encoding="base36"):
+    """Encode an array of counters as prefix-<id> strings in one vectorized pass."""
+    counters = np.asarray(counters, dtype=np.int64)
+    if encoding == "decimal":
+        return pl.select(pl.lit(f"{prefix}-") + pl.Series(counters).cast(pl.Utf8)).to_series()
+    if counters.size and counters.max() >= 36 ** ID_BASE36_WIDTH:
+        raise ValueError(f"ID counter space exhausted for prefix {prefix}")
+    powers = 36 ** np.arange(ID_BASE36_WIDTH - 1, -1, -1, dtype=np.int64)
+    # One character per (id, position); each row of characters is viewed as one fixed-width string.
+    chars = np.ascontiguousarray(ID_BASE36_DIGITS[(counters[:, None] // powers) % 36])
+    codes = chars.view(f"<U{ID_BASE36_WIDTH}").ravel()
+    return pl.select(pl.lit(f"{prefix}-") + pl.Series(codes, dtype=pl.Utf8)).to_series()
 
-    print(f"📤 Uploading {len(df)} delta rows to s3://{bucket}/{key}")
-    s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue(), ContentType="text/csv")
+def next_allocated_id(ids):
+    """Return the counter after the largest allocated ID in ids (legacy IDs are skipped), or 0."""
+    code = ids.cast(pl.Utf8).str.extract(r"-([0-9A-Z]+)$")
+    counters = pl.select(
+        pl.when(code.str.len_chars() == ID_BASE36_WIDTH).then(code.str.to_integer(base=36, strict=False))
+        .when((code.str.len_chars() > 10) & code.str.contains(r"^[0-9]+$")).then(code.str.to_integer(strict=False))
+    ).to_series()
+    largest = counters.max()
+    return largest + 1 if largest is not None else 0
 
-    # 🆕 Automatically update the meta file if the file is orders.csv
-    if filename == "orders.csv":
-        update_orders_meta_s3(datetime.date.today())
+class IdAllocator:
+    """Hand out unique IDs for one dataset; generators without one leave the ID column to the caller."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.column, self.prefix = ID_COLUMNS[filename]
+        self.encoding = get_id_encoding()
+        next_id = load_manifest(filename).get("next_id", 0)
+        self.next_id = max(next_id, ID_START[self.encoding])
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        """Reserve a block of n counters and return the first one."""
+        with self._lock:
+            start = self.next_id
+            self.next_id += n
+        return start
+
+    def ids(self, n):
+        """Return a Series of n new IDs."""
+        start = self.reserve(n)
+        return encode_ids(self.prefix, np.arange(start, start + n, dtype=np.int64), self.encoding).alias(self.column)
+
+    def assign(self, df):
+        """Return df with a newly allocated ID column in front."""
+        return df.select([self.ids(df.height), *[pl.col(c) for c in df.columns if c != self.column]])
+
+def get_last_date(filename):
+    """Return a dataset's watermark date from its manifest (O(1) after the first run), or None."""
+    last_date = load_manifest(filename).get("last_date")
+    return datetime.datetime.strptime(last_date, "%Y-%m-%d").date() if last_date else None
+
+def update_dataset(filename, new_data, allocator=None):
+    """Validate new rows and commit them to a dataset together with its manifest; returns the accepted rows."""
+    df_new = new_data if isinstance(new_data, pl.DataFrame) else pl.DataFrame(new_data)
+    with measure_stage("write", filename) as record, dataset_lock(filename):
+        record["rows_in"] = len(df_new)
+        recover_dataset(filename)
+        manifest = load_manifest(filename)
+        if get_validation_mode() != "off" and filename in PRIMARY_KEYS and not df_new.is_empty():
+            df_new = check_batch(filename, df_new, manifest)
+        new_last_date = max_watermark(df_new, filename)
+
+        if get_write_mode() == "append":
+            if df_new.is_empty():
+                print(f"⚠️ No new records for {filename}. Skipping.")
+                return df_new
+            schema = dataset_schema(filename)
+            if schema is not None:
+                df_new = align_to_schema(df_new, schema)
+            file_path = os.path.join(DATA_DIR, filename)
+            if get_storage_format() == "csv" and os.getenv("USE_S3", "false").lower() != "true":
+                # Record where the append starts, so recover_dataset can undo it if the commit never happens.
+                start = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                write_manifest(filename, dict(manifest, append_from=start))
+            keys = append_dataset(df_new, filename)
+            # A first Parquet append migrates the CSV, so the old part list no longer applies.
+            parts = manifest["parts"] if manifest["format"] == get_storage_format() else []
+            manifest["parts"] = parts + [k for k in keys if k not in parts]
+            manifest["row_count"] += len(df_new)
+            manifest["format"] = get_storage_format()
+            record["rows_out"] = len(df_new)
+            print(f"✅ Appended {len(df_new)} new records to {filename}.")
+        else:
+            if dataset_schema(filename) is None:
+                updated_df = df_new
+            else:
+                df_orig = read_dataset(filename)
+                df_new = align_to_schema(df_new, df_orig.schema)
+                updated_df = pl.concat([df_orig, df_new], how="vertical_relaxed")
+            stage_dataset(updated_df, filename, manifest)
+            record["rows_out"] = len(df_new)
+            print(f"✅ Updated {filename} with {len(new_data)} new records.")
+
+        if new_last_date and (manifest["last_date"] is None or new_last_date > manifest["last_date"]):
+            manifest["last_date"] = new_last_date
+        if allocator is not None:
+            manifest["next_id"] = max(manifest.get("next_id", 0), allocator.next_id)
+        if "key_index" in manifest and PRIMARY_KEYS.get(filename) in df_new.columns:
+            add_to_key_index(filename, manifest, df_new[PRIMARY_KEYS[filename]])
+        if os.getenv("EXPORT_DELTAS", "false").lower() == "true" and not df_new.is_empty():
+            deltas = manifest.setdefault("deltas", [])
+            seq = deltas[-1]["seq"] + 1 if deltas else 1
+            key = write_delta(df_new, filename, seq)
+            deltas.append({"seq": seq, "key": key, "rows": len(df_new), "last_date": new_last_date})
+        commit_manifest(filename, manifest)
+        publish(filename, lambda: finish_update(filename), final=True)
+    return df_new
+
+def finish_update(filename):
+    """Compact a dataset once it has more than S3_COMPACT_PARTS parts (default 30; 0 never compacts) and re-export its CSV."""
+    max_parts = int(os.getenv("S3_COMPACT_PARTS", "30"))
+    if max_parts and len(load_manifest(filename)["parts"]) > max_parts:
+        compact_dataset(filename)
+    if get_storage_format() == "parquet" and os.getenv("EXPORT_CSV", "false").lower() == "true":
+        export_csv(filename)
+
+def get_validation_mode():
+    """Return VALIDATION_MODE: "quarantine" (default), "reject" or "off"."""
+    mode = os.getenv("VALIDATION_MODE", "quarantine").lower()
+    if mode not in ("quarantine", "reject", "off"):
+        raise ValueError(f"Unsupported VALIDATION_MODE: {mode}")
+    return mode
+
+def key_index_prefix(filename):
+    """Prefix holding a dataset's key index parts (order_lines.csv -> indexes/order_lines/)."""
+    return f"{KEY_INDEX_PREFIX}{os.path.splitext(filename)[0]}/"
+
+def write_key_index_part(filename, keys):
+    """Write keys as a new key index part of a dataset; returns its key."""
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    key = f"{key_index_prefix(filename)}part-{stamp}-{uuid.uuid4().hex[:8]}.parquet"
+    df = keys.alias("key").to_frame()
+    if os.getenv("USE_S3", "false").lower() == "true":
+        upload_frame(df, key, "parquet")
+    else:
+        replace_file(os.path.join(DATA_DIR, key), df.write_parquet)
+    return key
+
+def read_key_index_part(key):
+    if os.getenv("USE_S3", "false").lower() == "true":
+        return download_frame(key, "parquet")["key"]
+    return pl.read_parquet(os.path.join(DATA_DIR, key))["key"]
+
+_key_indexes = {}
+_key_indexes_lock = threading.Lock()
+
+def load_key_index(filename, manifest):
+    """Return the persisted primary keys of a dataset as a Series, building the index on first use."""
+    parts = manifest.get("key_index")
+    if parts is None:
+        column = PRIMARY_KEYS[filename]
+        print(f"🗂️ Building the {filename} key index from a one-time scan")
+        try:
+            keys = read_dataset(filename, columns=[column])[column].unique(maintain_order=True).alias("key")
+        except (FileNotFoundError, ClientError) as e:
+            if isinstance(e, ClientError) and not is_missing_object(e):
+                raise
+            keys = pl.Series("key", [], dtype=pl.Utf8)
+        manifest["key_index"] = [write_key_index_part(filename, keys)]
+        with _key_indexes_lock:
+            _key_indexes[filename] = (list(manifest["key_index"]), keys)
+        return keys
+
+    with _key_indexes_lock:
+        cached_parts, keys = _key_indexes.get(filename, ([], None))
+    if keys is None or cached_parts != parts[:len(cached_parts)]:
+        cached_parts, keys = [], pl.Series("key", [], dtype=pl.Utf8)
+    if len(parts) > len(cached_parts):
+        keys = pl.concat([keys] + [read_key_index_part(key).cast(pl.Utf8) for key in parts[len(cached_parts):]])
+        with _key_indexes_lock:
+            _key_indexes[filename] = (list(parts), keys)
+    return keys
+
+def add_to_key_index(filename, manifest, keys):
+    """Record new keys of a dataset as a key index part in manifest."""
+    existing = load_key_index(filename, manifest)
+    keys = keys.cast(pl.Utf8).alias("key")
+    if len(manifest["key_index"]) >= KEY_INDEX_MAX_PARTS:
+        keys = pl.concat([existing, keys])
+        manifest["key_index"] = [write_key_index_part(filename, keys)]
+    else:
+        manifest["key_index"] = manifest["key_index"] + [write_key_index_part(filename, keys)]
+        keys = pl.concat([existing, keys])
+    with _key_indexes_lock:
+        _key_indexes[filename] = (list(manifest["key_index"]), keys)
+
+def reference_keys(filename):
+    """Return the key index of a referenced dataset, building and committing it first if it has none."""
+    with dataset_lock(filename):
+        manifest = load_manifest(filename)
+        if "key_index" in manifest:
+            return load_key_index(filename, manifest)
+        keys = load_key_index(filename, manifest)
+        commit_manifest(filename, manifest)
+        return keys
+
+def validate_batch(filename, df, manifest):
+    """Split a batch into (accepted, rejected) rows by its primary and foreign key checks."""
+    df = df.with_row_index("__row")
+    checks = []
+    column = PRIMARY_KEYS[filename]
+    if column in df.columns:
+        existing = load_key_index(filename, manifest).cast(df.schema[column]).alias(column).to_frame()
+        checks += [
+            df.filter(pl.col(column).is_null()).select("__row", pl.lit(f"null {column}").alias("reject_reason")),
+            df.filter(~pl.col(column).is_first_distinct() & pl.col(column).is_not_null())
+            .select("__row", pl.lit(f"duplicate {column}").alias("reject_reason")),
+            df.join(existing, on=column, how="semi").select("__row", pl.lit(f"existing {column}").alias("reject_reason")),
+        ]
+    for ref_column, ref_filename in FOREIGN_KEYS.get(filename, {}).items():
+        if ref_column not in df.columns:
+            continue
+        ref_keys = reference_keys(ref_filename).cast(df.schema[ref_column]).alias(ref_column).to_frame()
+        checks.append(
+            df.join(ref_keys, on=ref_column, how="anti").select("__row", pl.lit(f"missing {ref_column}").alias("reject_reason"))
+        )
+    if not checks:
+        return df.drop("__row"), df.drop("__row").clear().with_columns(pl.lit(None, dtype=pl.Utf8).alias("reject_reason"))
+    reasons = pl.concat(checks).unique("__row", keep="first", maintain_order=True)
+    accepted = df.filter(~pl.col("__row").is_in(reasons["__row"])).drop("__row")
+    rejected = df.join(reasons, on="__row", how="inner").sort("__row").drop("__row")
+    return accepted, rejected
+
+def quarantine_rows(filename, rejected):
+    """Write rejected rows (with their reject_reason) as quarantine/<stem>/<timestamp>.csv; returns the key."""
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    key = f"{QUARANTINE_PREFIX}{os.path.splitext(filename)[0]}/{stamp}-{uuid.uuid4().hex[:8]}.csv"
+    if os.getenv("USE_S3", "false").lower() == "true":
+        upload_frame(rejected, key)
+    else:
+        replace_file(os.path.join(DATA_DIR, key), rejected.write_csv)
+    return key
+
+def check_batch(filename, df, manifest):
+    """Validate a batch, report and quarantine the rejected rows and return the accepted ones."""
+    with measure_stage("validate", filename) as record:
+        record["rows_in"] = len(df)
+        accepted, rejected = validate_batch(filename, df, manifest)
+        record["rows_out"] = len(accepted)
+        record["rows_rejected"] = len(rejected)
+    if not rejected.is_empty():
+        counts = rejected["reject_reason"].value_counts(sort=True).rows()
+        summary = ", ".join(f"{count} {reason}" for reason, count in counts)
+        print(f"🚫 Rejected {len(rejected)} of {len(df)} new {filename} rows: {summary}")
+        if get_validation_mode() == "quarantine":
+            key = quarantine_rows(filename, rejected)
+            print(f"🧪 Quarantined them in {key}")
+    return accepted
+
+def get_memory_budget():
+    """Bytes of generated rows a ChunkWriter may buffer before flushing (GENERATION_MEMORY_MB, default 256)."""
+    return int(float(os.getenv("GENERATION_MEMORY_MB", "256")) * 1024 * 1024)
+
+class ChunkWriter:
+    """Buffer a generator's chunks and flush them whenever they exceed the memory budget, however long the backfill."""
+
+    def __init__(self, filename, allocator=None, budget=None, upstream=()):
+        self.filename = filename
+        self.allocator = allocator
+        self.budget = budget if budget is not None else get_memory_budget()
+        self.upstream = list(upstream)
+        self.rows_written = 0
+        self._chunks = []
+        self._buffered = 0
+
+    def write(self, chunk):
+        if chunk.is_empty():
+            return
+        self._chunks.append(chunk)
+        self._buffered += chunk.estimated_size()
+        if self._buffered >= self.budget:
+            return self.flush()
+
+    def flush(self):
+        """Write the buffered chunks; returns the rows validation accepted (None if nothing was buffered)."""
+        # Upstream writers go first, so validation finds the keys these rows reference.
+        for writer in self.upstream:
+            writer.flush()
+        if not self._chunks:
+            return
+        df = pl.concat(self._chunks, how="diagonal_relaxed")
+        self._chunks, self._buffered = [], 0
+        if self.allocator is not None and self.allocator.column not in df.columns:
+            df = self.allocator.assign(df)
+        accepted = update_dataset(self.filename, df, self.allocator)
+        self.rows_written += len(accepted)
+        return accepted
+
+def write_chunks(chunks, filename, allocator=None, budget=None):
+    """Write an iterable of generated chunks through a ChunkWriter; returns the number of rows accepted."""
+    writer = ChunkWriter(filename, allocator, budget)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.flush()
+    return writer.rows_written
+
+def write_delta(df, filename, seq):
+    """Write the rows one update added as a typed Parquet delta for incremental loaders; returns its key."""
+    if filename in DATASET_SCHEMAS:
+        df = df.cast(DATASET_SCHEMAS[filename])
+    key = f"{DELTA_PREFIX}{os.path.splitext(filename)[0]}/{seq:08d}.parquet"
+    if os.getenv("USE_S3", "false").lower() == "true":
+        print(f"📤 Uploading {len(df)} delta rows to s3://{os.getenv('AWS_S3_BUCKET')}/{key}")
+        upload_frame(df, key, "parquet")
+    else:
+        replace_file(os.path.join(DATA_DIR, key),
+                     lambda path: df.write_parquet(path, compression=os.getenv("PARQUET_COMPRESSION", "zstd")))
+    return key
 
 def get_last_order_date_s3():
-    s3 = boto3.client(
-        "s3",
-        region_name="us-east-1",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        aws_session_token=os.getenv("AWS_SESSION_TOKEN")
-    )
+    s3 = get_s3_client()
     bucket = os.getenv("AWS_S3_BUCKET")
     key = "orders_last_date.txt"
 
@@ -119,16 +1656,11 @@ def get_last_order_date_s3():
         return datetime.date.today() - datetime.timedelta(days=1)
 
 def update_orders_meta_s3(current_date):
-    s3 = boto3.client(
-        "s3",
-        region_name="us-east-1",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        aws_session_token=os.getenv("AWS_SESSION_TOKEN")
-    )
+    s3 = get_s3_client()
     bucket = os.getenv("AWS_S3_BUCKET")
     key = "orders_last_date.txt"
     body = current_date.strftime("%Y-%m-%d")
 
     s3.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"), ContentType="text/plain")
+    count_bytes(written=len(body))
     print(f"📄 Updated orders_last_date.txt to {body} in S3")
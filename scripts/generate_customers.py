@@ -1,73 +1,167 @@
 import datetime
-import random
-from common import generate_id, read_csv, update_dataset
-
-
-def generate_customers(today, customer_locations, merchant_types, existing_customer_ids, num_customers_range=(10, 20)):
-    df = read_csv("customer.csv")
-    if df.height > 0 and "customer_created_date" in df.columns:
-        max_date_str = df["customer_created_date"].drop_nulls().max()
-        try:
-            last_date = datetime.datetime.strptime(max_date_str, "%Y-%m-%d").date()
-        except Exception:
-            last_date = today - datetime.timedelta(days=1)
+import os
+
+import polars as pl
+from common import (
+    MERCHANT_TYPES,
+    IdAllocator,
+    as_frame,
+    concat_frames,
+    date_column,
+    day_rng,
+    get_last_date,
+    get_scale_factor,
+    random_choice,
+    read_dataset,
+    scale_range,
+    write_chunks,
+)
+
+FIRST_NAMES = ['Emma', 'Olivia', 'Liam', 'Noah', 'Ava', 'James', 'Mark']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams']
+LOCATION_COLUMNS = [
+    "customer_city", "customer_state", "customer_country",
+    "geo__customer_city__city_pushpin_longitude",
+    "geo__customer_city__city_pushpin_latitude"
+]
+READS = {"customer.csv": ["customer_id", "customer_email", *LOCATION_COLUMNS]}
+# New customers per day at SCALE_FACTOR=1.
+CUSTOMERS_PER_DAY = (10, 20)
+
+
+# Emails are <first>.<last>_<suffix>@example.com; the local part before the suffix is the email's name key.
+EMAIL_PATTERN = r"^(?P<key>.+)_(?P<suffix>\d+)@example\.com$"
+
+
+def email_keys(first, last):
+    return pl.select(pl.concat_str([first.str.to_lowercase(), pl.lit("."), last.str.to_lowercase()])).to_series()
+
+
+def build_emails(keys, suffix):
+    return pl.select(pl.concat_str([keys, pl.lit("_"), suffix.cast(pl.Utf8), pl.lit("@example.com")])).to_series()
+
+
+class EmailSuffixes:
+    """The highest email suffix used so far per name key, so new emails are unique without rescanning."""
+
+    def __init__(self, existing_emails):
+        parts = existing_emails.str.extract_groups(EMAIL_PATTERN)
+        self.table = (
+            pl.DataFrame({"key": parts.struct.field("key"), "suffix": parts.struct.field("suffix").cast(pl.Int64)})
+            .drop_nulls()
+            .group_by("key")
+            .agg(pl.col("suffix").max())
+        )
+
+    def next(self, keys):
+        """Return a fresh suffix for each name key in keys (a Series) and record them as used."""
+        used = keys.replace_strict(self.table["key"], self.table["suffix"], default=0, return_dtype=pl.Int64)
+        suffix = (
+            pl.DataFrame({"key": keys, "used": used})
+            .select(pl.col("used") + pl.int_range(1, pl.len() + 1).over("key"))
+            .to_series()
+        )
+        self.table = (
+            pl.concat([self.table, pl.DataFrame({"key": keys, "suffix": suffix})])
+            .group_by("key")
+            .agg(pl.col("suffix").max())
+        )
+        return suffix
+
+
+def get_email_suffix_mode():
+    """Return EMAIL_SUFFIXES: random or sequential (the default above SCALE_FACTOR=1)."""
+    mode = os.getenv("EMAIL_SUFFIXES", "sequential" if get_scale_factor() > 1 else "random").lower()
+    if mode not in ("random", "sequential"):
+        raise ValueError(f"Unsupported EMAIL_SUFFIXES: {mode}")
+    return mode
+
+
+def generate_names_and_emails(n, existing_emails, rng, max_attempts=11, suffixes=None):
+    """Draw n names with emails unique against existing_emails and each other."""
+    first = random_choice(FIRST_NAMES, n, rng)
+    last = random_choice(LAST_NAMES, n, rng)
+    if suffixes is not None:
+        keys = email_keys(first, last)
+        emails = build_emails(keys, suffixes.next(keys))
     else:
-        last_date = today - datetime.timedelta(days=1)
-
-    existing_emails = set(df["customer_email"].to_list()) if "customer_email" in df.columns else set()
-
-    first_names = ['Emma', 'Olivia', 'Liam', 'Noah', 'Ava', 'James', 'Mark']
-    last_names = ['Smith', 'Johnson', 'Williams']
-
-    new_customers = []
-    dt = last_date + datetime.timedelta(days=1)
-    while dt <= today:
-        for _ in range(random.randint(*num_customers_range)):
-            new_customer_id = generate_id("C")
-
-            # Generate unique email
-            attempt = 0
-            while True:
-                first = random.choice(first_names)
-                last = random.choice(last_names)
-                email = f"{first.lower()}.{last.lower()}_{random.randint(1, 9999)}@example.com"
-                if email not in existing_emails or attempt > 10:
-                    existing_emails.add(email)
-                    break
-                attempt += 1
-
-            full_name = f"{first} {last}"
-            location = random.choice(customer_locations)
-            merchant_type = random.choice(merchant_types)
-            customer = {
-                "customer_id": new_customer_id,
-                "ls__customer_id__customer_name": full_name,
-                "customer_city": location["customer_city"],
-                "geo__customer_city__city_pushpin_longitude": location["geo__customer_city__city_pushpin_longitude"],
-                "geo__customer_city__city_pushpin_latitude": location["geo__customer_city__city_pushpin_latitude"],
-                "customer_country": location["customer_country"],
-                "customer_email": email,
-                "customer_state": location["customer_state"],
-                "customer_created_date": dt.strftime("%Y-%m-%d"),
-                "wdf__client_id": merchant_type,
-            }
-            new_customers.append(customer)
-            existing_customer_ids.append(new_customer_id)
+        suffix = pl.Series(rng.integers(1, 10000, size=n))
+        for attempt in range(max_attempts):
+            keys = email_keys(first, last)
+            emails = build_emails(keys, suffix)
+            colliding = (emails.is_in(existing_emails.implode()) | ~emails.is_first_distinct()).to_numpy()
+            k = int(colliding.sum())
+            if k == 0:
+                break
+            idx = colliding.nonzero()[0]
+            if attempt == max_attempts - 1:
+                fallback = EmailSuffixes(existing_emails.append(emails.filter(~pl.Series(colliding))))
+                emails = emails.scatter(idx, build_emails(keys.gather(idx), fallback.next(keys.gather(idx))))
+                break
+            first = first.scatter(idx, random_choice(FIRST_NAMES, k, rng))
+            last = last.scatter(idx, random_choice(LAST_NAMES, k, rng))
+            suffix = suffix.scatter(idx, rng.integers(1, 10000, size=k))
+    full_names = pl.select(pl.concat_str([first, pl.lit(" "), last])).to_series()
+    return full_names, emails
+
+
+def iter_customers(from_date, to_date, customer_locations, merchant_types, existing_emails,
+                   num_customers_range=None, rng=None):
+    """Yield the customers of every day in (from_date, to_date] as one chunk per day."""
+    num_customers_range = num_customers_range or scale_range(CUSTOMERS_PER_DAY)
+    suffixes = EmailSuffixes(existing_emails) if get_email_suffix_mode() == "sequential" else None
+    if suffixes is None:
+        existing_emails = existing_emails.clone()
+    locations = as_frame(customer_locations)
+    dt = from_date + datetime.timedelta(days=1)
+    while dt <= to_date:
+        day_stream = rng if rng is not None else day_rng("customer.csv", dt)
+        n = int(day_stream.integers(num_customers_range[0], num_customers_range[1] + 1))
+        full_names, emails = generate_names_and_emails(n, existing_emails, day_stream, suffixes=suffixes)
+        if suffixes is None:
+            existing_emails = existing_emails.append(emails)
+        location = locations.gather(day_stream.integers(0, locations.height, size=n))
+        yield pl.DataFrame({
+            "ls__customer_id__customer_name": full_names,
+            "customer_city": location["customer_city"],
+            "geo__customer_city__city_pushpin_longitude": location["geo__customer_city__city_pushpin_longitude"],
+            "geo__customer_city__city_pushpin_latitude": location["geo__customer_city__city_pushpin_latitude"],
+            "customer_country": location["customer_country"],
+            "customer_email": emails,
+            "customer_state": location["customer_state"],
+            "customer_created_date": date_column(dt, n),
+            "wdf__client_id": random_choice(merchant_types, n, day_stream),
+        })
         dt += datetime.timedelta(days=1)
-    return new_customers
+
+
+def get_last_customer_date(today):
+    return get_last_date("customer.csv") or today - datetime.timedelta(days=1)
+
+
+def generate_customers(today, customer_locations, merchant_types, existing_customer_ids, num_customers_range=None, rng=None,
+                       existing_emails=None, allocator=None):
+    """Generate the customers of every day after the customer watermark up to today as one frame."""
+    if existing_emails is None:
+        existing_emails = read_dataset("customer.csv", columns=["customer_email"])["customer_email"]
+    customers = concat_frames(list(iter_customers(get_last_customer_date(today), today, customer_locations,
+                                                  merchant_types, existing_emails, num_customers_range, rng)))
+    if allocator is None:
+        return customers
+    customers = allocator.assign(customers)
+    if isinstance(existing_customer_ids, list):
+        existing_customer_ids.extend(customers["customer_id"].to_list())
+    return customers
 
 
 if __name__ == "__main__":
     today = datetime.date.today()
-    customer_df = read_csv("customer.csv")
-    existing_customer_ids = customer_df["customer_id"].to_list()
-    customer_locations = customer_df.select([
-        "customer_city", "customer_state", "customer_country",
-        "geo__customer_city__city_pushpin_longitude",
-        "geo__customer_city__city_pushpin_latitude"
-    ]).unique().to_dicts()
-    merchant_types = ["merchant__electronics", "merchant__clothing", "merchant__bigboxretailer"]
-
-    new_customers = generate_customers(today, customer_locations, merchant_types, existing_customer_ids)
-    print(f"Generated {len(new_customers)} new customers since last update up to today.")
-    update_dataset("customer.csv", new_customers)
\ No newline at end of file
+    customer_df = read_dataset("customer.csv", columns=READS["customer.csv"])
+    customer_locations = customer_df.select(LOCATION_COLUMNS).unique(maintain_order=True)
+
+    written = write_chunks(
+        iter_customers(get_last_customer_date(today), today, customer_locations, MERCHANT_TYPES,
+                       customer_df["customer_email"]),
+        "customer.csv", IdAllocator("customer.csv"),
+    )
+    print(f"Generated {written} new customers since last update up to today.")
\ No newline at end of file
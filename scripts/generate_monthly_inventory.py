@@ -1,56 +1,84 @@
 import datetime
-import random
-from common import generate_id, read_csv, update_dataset
 
+import numpy as np
+import polars as pl
+from common import (
+    MERCHANT_TYPES,
+    IdAllocator,
+    as_series,
+    base_date_incr,
+    day_rng,
+    read_dataset,
+    write_chunks,
+)
 
-def generate_monthly_inventory(today, existing_product_ids):
-    df = read_csv("monthly_inventory.csv")
-    current_month = today.replace(day=1).strftime("%Y-%m-01")
-    if current_month in df["inventory_month"].to_list():
+READS = {"product.csv": ["product_id"], "monthly_inventory.csv": ["inventory_month"]}
+# First month generated when there is no inventory yet.
+FIRST_MONTH = datetime.date(2024, 2, 1)
+
+
+def read_inventory_months():
+    """Return the inventory_month column of the stored inventory (empty if there is none yet)."""
+    try:
+        return read_dataset("monthly_inventory.csv", columns=READS["monthly_inventory.csv"])["inventory_month"]
+    except FileNotFoundError:
+        return pl.Series("inventory_month", [], dtype=pl.Utf8)
+
+
+def missing_months(today, existing_months):
+    """Return the first days of the months up to today's that have no inventory yet, gaps included."""
+    stored = as_series(existing_months).str.to_date("%Y-%m-%d").unique().alias("month").to_frame()
+    first = stored["month"].min() or FIRST_MONTH
+    calendar = pl.date_range(first, today.replace(day=1), "1mo", eager=True).alias("month").to_frame()
+    return calendar.join(stored, on="month", how="anti").sort("month")["month"].to_list()
+
+
+def build_monthly_inventory(months, existing_product_ids, rng=None):
+    """Build one inventory row per (month, product) for a non-empty list of months."""
+    product_ids = as_series(existing_product_ids).alias("product__product_id")
+    n = len(product_ids)
+    eom, clients, bom = [], [], []
+    for month in months:
+        month_stream = rng if rng is not None else day_rng("monthly_inventory.csv", month)
+        incr = (month - base_date_incr).days * 0.1
+        eom.append(np.round(month_stream.integers(300, 2001, size=n) + incr, 2))
+        clients.append(month_stream.integers(0, len(MERCHANT_TYPES), size=n))
+        bom.append(np.round(month_stream.integers(300, 2001, size=n) + incr, 2))
+
+    # Dates are formatted once per month, before the join repeats them per product.
+    grid = pl.DataFrame({
+        "inventory_month": [f"{month:%Y-%m-01}" for month in months],
+        "date": [f"{month:%Y-%m-%d} 00:00:00.000" for month in months],
+    }).join(product_ids.to_frame(), how="cross")
+    return grid.select(
+        "product__product_id",
+        "inventory_month",
+        pl.Series("monthly_quantity_eom", np.concatenate(eom)),
+        as_series(MERCHANT_TYPES).gather(np.concatenate(clients)).alias("wdf__client_id"),
+        pl.Series("monthly_quantity_bom", np.concatenate(bom)),
+        "date",
+    )
+
+
+def generate_monthly_inventory(today, existing_product_ids, rng=None, allocator=None, existing_months=None):
+    """Generate the missing monthly inventory up to today as one frame (existing_months is read when not given)."""
+    if existing_months is None:
+        existing_months = read_inventory_months()
+    months = missing_months(today, existing_months)
+    if not months:
         print("Monthly inventory already generated for this month. Skipping inventory generation.")
-        return []
-
-    new_inventory = []
-    if df.height > 0 and "date" in df.columns:
-        last_inv_val = df["date"].drop_nulls().max()
-        try:
-            last_inv_date = datetime.datetime.strptime(last_inv_val, "%Y-%m-%d").date()
-        except ValueError:
-            last_inv_date = datetime.datetime.strptime(last_inv_val.split()[0], "%Y-%m-%d").date()
-    else:
-        last_inv_date = datetime.date(2024, 1, 1)
-
-    start_year = last_inv_date.year + (last_inv_date.month // 12)
-    start_month = (last_inv_date.month % 12) + 1
-    current_month_date = datetime.date(start_year, start_month, 1)
-
-    while current_month_date <= today:
-        incr = (current_month_date - datetime.date(2022, 1, 1)).days * 0.1
-        for product_id in existing_product_ids:
-            base_bom = random.randint(300, 2000)
-            base_eom = random.randint(300, 2000)
-            inv = {
-                "monthly_inventory_id": generate_id("M"),
-                "product__product_id": product_id,
-                "inventory_month": current_month_date.strftime("%Y-%m-01"),
-                "monthly_quantity_eom": float(round(base_eom + incr, 2)),
-                "wdf__client_id": random.choice([
-                    "merchant__electronics", "merchant__clothing", "merchant__bigboxretailer"]),
-                "monthly_quantity_bom": float(round(base_bom + incr, 2)),
-                "date": current_month_date.strftime("%Y-%m-%d %H:%M:%S.000"),
-            }
-            new_inventory.append(inv)
-        if current_month_date.month == 12:
-            current_month_date = datetime.date(current_month_date.year + 1, 1, 1)
-        else:
-            current_month_date = datetime.date(current_month_date.year, current_month_date.month + 1, 1)
-    return new_inventory
+        return pl.DataFrame()
+    latest = as_series(existing_months).max()
+    if latest is not None and f"{months[0]:%Y-%m-01}" < latest:
+        print(f"🧩 Filling inventory gaps from {months[0]:%Y-%m}")
+    inventory = build_monthly_inventory(months, existing_product_ids, rng)
+    return allocator.assign(inventory) if allocator is not None else inventory
 
 
 if __name__ == "__main__":
     today = datetime.date.today()
-    product_df = read_csv("product.csv")
-    existing_product_ids = product_df["product_id"].to_list()
-    new_inventory = generate_monthly_inventory(today, existing_product_ids)
-    print(f"Generated {len(new_inventory)} new monthly inventory records.")
-    update_dataset("monthly_inventory.csv", new_inventory)
+    product_df = read_dataset("product.csv", columns=READS["product.csv"])
+    existing_product_ids = product_df["product_id"]
+    inventory = generate_monthly_inventory(today, existing_product_ids)
+    written = write_chunks([inventory], "monthly_inventory.csv", IdAllocator("monthly_inventory.csv"))
+    print(f"Generated {written} new monthly inventory records.")
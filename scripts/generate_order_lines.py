@@ -1,86 +1,145 @@
 import datetime
-import random
 import os
-import polars as pl
-from common import generate_id, read_csv, update_dataset
 
-def get_last_order_line_date():
+import numpy as np
+import polars as pl
+from common import (
+    IdAllocator,
+    as_series,
+    base_date_incr,
+    concat_frames,
+    date_column,
+    day_rng,
+    get_last_date,
+    random_amount,
+    random_choice,
+    read_dataset,
+    write_chunks,
+)
+
+# Orders generated in the same pipeline run also carry their customer_id.
+READS = {
+    "orders.csv": ["order_id", "wdf__client_id"],
+    "customer.csv": ["customer_id"],
+    "product.csv": ["product_id"],
+}
+# Lines per sampled order and the share of orders sampled per day. Both are
+# ratios: order lines grow with SCALE_FACTOR through the orders they sample.
+LINES_PER_ORDER = (8, 13)
+ORDER_SAMPLE_FRACTION = 0.01
+
+def get_last_order_line_date(current_date):
     try:
-        df = read_csv("order_lines.csv")
-        df = df.with_columns(
-            pl.col("order_date").str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S%.3f")
-        )
-        last_date = df["order_date"].max().date()
-        return last_date
+        last_date = get_last_date("order_lines.csv")
     except Exception as e:
         print(f"Could not read last order line date: {e}")
-        return datetime.date.today() - datetime.timedelta(days=1)
-
-
-def generate_order_lines(from_date, to_date, orders_df, existing_product_ids, existing_customer_ids, num_order_lines_range=(8, 13)):
-    new_order_lines = []
+        last_date = None
+    return last_date or current_date - datetime.timedelta(days=1)
+
+
+class OrderIndex:
+    """The orders order lines are drawn from, as contiguous columns sampled by position."""
+
+    def __init__(self, orders_df, by_date=False):
+        self.by_date = by_date and "order_date" in orders_df.columns
+        if self.by_date:
+            orders_df = orders_df.sort("order_date", nulls_last=False)
+            # Unparseable or missing dates sort first, i.e. before every day.
+            dates = orders_df["order_date"].str.slice(0, 10).str.to_date("%Y-%m-%d", strict=False)
+            self.day_numbers = dates.cast(pl.Int32).fill_null(np.iinfo(np.int32).min).to_numpy()
+        self.columns = orders_df.select(["order_id", "wdf__client_id", "customer_id"]).rechunk()
+
+    def count(self, day):
+        """Number of orders a day can sample from."""
+        if not self.by_date:
+            return self.columns.height
+        return int(np.searchsorted(self.day_numbers, (day - datetime.date(1970, 1, 1)).days, side="right"))
+
+    def sample(self, day, fraction, rng):
+        """Sample fraction of the orders available on day, without replacement, by position."""
+        available = self.count(day)
+        return self.columns.gather(rng.choice(available, size=int(available * fraction), replace=False))
+
+
+def generate_order_lines_for_day(day, orders_for_day, product_ids, rng, num_order_lines_range=LINES_PER_ORDER):
+    """Expand the sampled orders of one day into order lines, column by column."""
+    lines_per_order = rng.integers(num_order_lines_range[0], num_order_lines_range[1] + 1, size=orders_for_day.height)
+    parents = orders_for_day.gather(np.repeat(np.arange(orders_for_day.height), lines_per_order))
+    n = parents.height
+    incr = (day - base_date_incr).days * 0.1
+    timestamp = date_column(day, n, "%Y-%m-%d %H:%M:%S.000")
+    return pl.DataFrame({
+        "order__order_id": parents["order_id"],
+        "product__product_id": random_choice(product_ids, n, rng),
+        "customer__customer_id": parents["customer_id"],
+        "order_unit_price": random_amount(5, 200, n, rng, incr),
+        "order_unit_quantity": rng.integers(1, 6, size=n).astype(float),
+        "wdf__client_id": parents["wdf__client_id"],
+        "order_unit_discount": random_amount(0, 50, n, rng),
+        "order_unit_cost": random_amount(5, 150, n, rng, incr),
+        "date": timestamp,
+        "order_date": timestamp,
+        "customer_age": pl.Series(rng.integers(18, 71, size=n)).cast(pl.Utf8) + "M+",
+    })
+
+
+def iter_order_lines(from_date, to_date, orders_df, existing_product_ids, existing_customer_ids,
+                     num_order_lines_range=LINES_PER_ORDER, rng=None, by_date=None):
+    """Yield the order lines of every day in (from_date, to_date] as one chunk per day."""
+    if by_date is None:
+        by_date = os.getenv("ORDER_LINES_BY_DATE", "false").lower() == "true"
+    index = OrderIndex(orders_df, by_date)
+    product_ids = as_series(existing_product_ids)
     current_date = from_date + datetime.timedelta(days=1)
 
     while current_date <= to_date:
-        orders_for_day = orders_df.sample(n=int(orders_df.height * 0.01)) if orders_df.height > 0 else pl.DataFrame(schema=orders_df.schema)
-
-        if orders_for_day.height == 0:
+        if int(index.count(current_date) * ORDER_SAMPLE_FRACTION) == 0:
             print(f"No orders available for {current_date}. Skipping.")
             current_date += datetime.timedelta(days=1)
             continue
 
-        incr = (current_date - datetime.date(2022, 1, 1)).days * 0.1
-        daily_generated_lines = 0
-
-        for order in orders_for_day.iter_rows(named=True):
-            for _ in range(random.randint(*num_order_lines_range)):
-                base_price = random.uniform(5, 200)
-                base_cost = random.uniform(5, 150)
-                order_line = {
-                    "order_line_id": generate_id("L"),
-                    "order__order_id": order["order_id"],
-                    "product__product_id": random.choice(existing_product_ids),
-                    "customer__customer_id": order["customer_id"],
-                    "order_unit_price": round(base_price + incr, 2),
-                    "order_unit_quantity": float(random.randint(1, 5)),
-                    "wdf__client_id": order["wdf__client_id"],
-                    "order_unit_discount": round(random.uniform(0, 50), 2),
-                    "order_unit_cost": round(base_cost + incr, 2),
-                    "date": current_date.strftime("%Y-%m-%d %H:%M:%S.000"),
-                    "order_date": current_date.strftime("%Y-%m-%d %H:%M:%S.000"),
-                    "customer_age": f"{random.randint(18, 70)}M+",
-                }
-                new_order_lines.append(order_line)
-                daily_generated_lines += 1
-
-        print(f"Generated {daily_generated_lines} order lines for {current_date}.")
+        day_stream = rng if rng is not None else day_rng("order_lines.csv", current_date)
+        orders_for_day = index.sample(current_date, ORDER_SAMPLE_FRACTION, day_stream)
+        day_lines = generate_order_lines_for_day(current_date, orders_for_day, product_ids, day_stream,
+                                                 num_order_lines_range)
+        print(f"Generated {day_lines.height} order lines for {current_date}.")
+        yield day_lines
         current_date += datetime.timedelta(days=1)
 
-    return new_order_lines
+
+def generate_order_lines(from_date, to_date, orders_df, existing_product_ids, existing_customer_ids, num_order_lines_range=LINES_PER_ORDER, rng=None,
+                         allocator=None, by_date=None):
+    """Generate the order lines of every day in (from_date, to_date] as one frame."""
+    order_lines = concat_frames(list(iter_order_lines(from_date, to_date, orders_df, existing_product_ids,
+                                                      existing_customer_ids, num_order_lines_range, rng, by_date)))
+    return allocator.assign(order_lines) if allocator is not None else order_lines
 
 
 if __name__ == "__main__":
     today = datetime.date.today()
 
-    orders_df = read_csv("orders.csv")
-    customers_df = read_csv("customer.csv")
-    product_df = read_csv("product.csv")
+    orders_df = read_dataset("orders.csv", columns=READS["orders.csv"])
+    customers_df = read_dataset("customer.csv", columns=READS["customer.csv"])
+    product_df = read_dataset("product.csv", columns=READS["product.csv"])
 
-    existing_product_ids = product_df["product_id"].to_list()
-    existing_customer_ids = customers_df["customer_id"].to_list()
+    existing_product_ids = product_df["product_id"]
+    existing_customer_ids = customers_df["customer_id"]
 
     if "customer_id" not in orders_df.columns:
         orders_df = orders_df.with_columns(
-            pl.Series("customer_id", [random.choice(existing_customer_ids) for _ in range(orders_df.height)])
+            random_choice(existing_customer_ids, orders_df.height, day_rng("orders.csv:customer_id", today))
+            .alias("customer_id")
         )
 
-    last_date = get_last_order_line_date()
+    last_date = get_last_order_line_date(today)
     print(f"Last order line date detected: {last_date}")
 
-    new_order_lines = generate_order_lines(last_date, today, orders_df, existing_product_ids, existing_customer_ids)
+    written = write_chunks(
+        iter_order_lines(last_date, today, orders_df, existing_product_ids, existing_customer_ids),
+        "order_lines.csv", IdAllocator("order_lines.csv"),
+    )
 
-    if new_order_lines:
-        update_dataset("order_lines.csv", new_order_lines)
-        print(f"Updated order_lines.csv with {len(new_order_lines)} new records.")
+    if written:
+        print(f"Updated order_lines.csv with {written} new records.")
     else:
         print("No new order lines generated.")
@@ -1,21 +1,40 @@
 import datetime
 import os
-import random
 import polars as pl
 
 from common import (
-    generate_id,
-    read_csv,
-    update_dataset,
+    DATA_DIR,
+    MERCHANT_TYPES,
+    IdAllocator,
+    as_series,
+    concat_frames,
+    date_column,
+    day_rng,
+    get_last_date,
+    measure_stage,
+    random_choice,
+    read_dataset,
+    replace_file,
+    scale_range,
+    write_chunks,
     get_last_order_date_s3,
     update_orders_meta_s3
 )
 
+ORDER_STATUSES = ["Processed", "Completed", "In Cart", "Canceled"]
+READS = {"customer.csv": ["customer_id"]}
+# Orders per day at SCALE_FACTOR=1.
+ORDERS_PER_DAY = (80, 120)
+
 # Path used only for local fallback
-ORDERS_META_FILE = os.path.join(os.path.dirname(__file__), "..", "data", "orders_last_date.txt")
+ORDERS_META_FILE = os.path.join(DATA_DIR, "orders_last_date.txt")
 
 
 def get_last_order_date(current_date):
+    last_date = get_last_date("orders.csv")
+    if last_date is not None:
+        return last_date
+    # Fall back to the legacy orders_last_date.txt watermark.
     if os.getenv("USE_S3", "false").lower() == "true":
         return get_last_order_date_s3()
     if os.path.exists(ORDERS_META_FILE):
@@ -29,55 +48,72 @@ def get_last_order_date(current_date):
 
 
 def update_orders_meta(current_date):
-    if os.getenv("USE_S3", "false").lower() == "true":
-        return update_orders_meta_s3(current_date)
-    with open(ORDERS_META_FILE, "w") as f:
-        f.write(current_date.strftime("%Y-%m-%d"))
+    with measure_stage("meta_update", "orders.csv"):
+        if os.getenv("USE_S3", "false").lower() == "true":
+            return update_orders_meta_s3(current_date)
+        body = current_date.strftime("%Y-%m-%d")
+
+        def write(path):
+            with open(path, "w") as f:
+                f.write(body)
+
+        replace_file(ORDERS_META_FILE, write)
+
+
+def generate_orders_for_day(day, existing_customer_ids, rng, num_orders_range=ORDERS_PER_DAY):
+    """Generate one day of orders as a DataFrame, column by column."""
+    n = int(rng.integers(num_orders_range[0], num_orders_range[1] + 1))
+    return pl.DataFrame({
+        "wdf__client_id": random_choice(MERCHANT_TYPES, n, rng),
+        "order_status": random_choice(ORDER_STATUSES, n, rng),
+        "order_date": date_column(day, n),
+        "customer_id": random_choice(existing_customer_ids, n, rng),
+    })
+
+
+def iter_orders(from_date, to_date, existing_customer_ids, num_orders_range=None, rng=None):
+    """Yield the orders of every day in (from_date, to_date] as one chunk per day."""
+    num_orders_range = num_orders_range or scale_range(ORDERS_PER_DAY)
+    customer_ids = as_series(existing_customer_ids)
+    dt = from_date + datetime.timedelta(days=1)
+    while dt <= to_date:
+        day_stream = rng if rng is not None else day_rng("orders.csv", dt)
+        yield generate_orders_for_day(dt, customer_ids, day_stream, num_orders_range)
+        dt += datetime.timedelta(days=1)
+
+
+def generate_orders_range(from_date, to_date, existing_customer_ids, num_orders_range=None, rng=None,
+                          allocator=None):
+    """Generate the orders of every day in (from_date, to_date] as one frame."""
+    orders = concat_frames(list(iter_orders(from_date, to_date, existing_customer_ids, num_orders_range, rng)))
+    return allocator.assign(orders) if allocator is not None else orders
 
 
-def generate_orders(current_date, existing_customer_ids, num_orders_range=(80, 120)):
+def generate_orders(current_date, existing_customer_ids, num_orders_range=None, rng=None, allocator=None):
     last_date = get_last_order_date(current_date)
     print(f"📅 Last order date: {last_date} — Generating up to: {current_date}")
 
     if last_date >= current_date:
         print("✅ Orders already up-to-date. Skipping generation.")
-        return []
-
-    new_orders = []
-    dt = last_date + datetime.timedelta(days=1)
-    while dt <= current_date:
-        for _ in range(random.randint(*num_orders_range)):
-            new_order_id = generate_id("O")
-            order = {
-                "order_id": new_order_id,
-                "wdf__client_id": random.choice([
-                    "merchant__electronics",
-                    "merchant__clothing",
-                    "merchant__bigboxretailer"
-                ]),
-                "order_status": random.choice([
-                    "Processed",
-                    "Completed",
-                    "In Cart",
-                    "Canceled"
-                ]),
-                "order_date": dt.strftime("%Y-%m-%d"),
-                "customer_id": random.choice(existing_customer_ids)
-            }
-            new_orders.append(order)
-        dt += datetime.timedelta(days=1)
+        return pl.DataFrame()
 
-    return new_orders
+    return generate_orders_range(last_date, current_date, existing_customer_ids, num_orders_range, rng, allocator)
 
 
 if __name__ == "__main__":
     today = datetime.date.today()
-    customer_df = read_csv("customer.csv")
-    existing_customer_ids = customer_df["customer_id"].to_list()
-
-    new_orders = generate_orders(today, existing_customer_ids)
-    print(f"Generated {len(new_orders)} new orders.")
+    customer_df = read_dataset("customer.csv", columns=READS["customer.csv"])
+    existing_customer_ids = customer_df["customer_id"]
 
-    if new_orders:
-        update_dataset("orders.csv", new_orders)
-        update_orders_meta(today)
\ No newline at end of file
+    last_date = get_last_order_date(today)
+    print(f"📅 Last order date: {last_date} — Generating up to: {today}")
+    if last_date >= today:
+        print("✅ Orders already up-to-date. Skipping generation.")
+    else:
+        written = write_chunks(iter_orders(last_date, today, existing_customer_ids), "orders.csv",
+                               IdAllocator("orders.csv"))
+        print(f"Generated {written} new orders.")
+        # Each flush already committed its orders with the manifest watermark;
+        # orders_last_date.txt is only the legacy fallback copy.
+        if written:
+            update_orders_meta(today)
\ No newline at end of file
@@ -1,94 +1,114 @@
 import datetime
-import random
 import os
 
 import polars as pl
 
-from common import generate_id, read_csv, update_dataset
-
-
-def get_last_return_date():
+from common import (
+    IdAllocator,
+    as_series,
+    base_date_incr,
+    concat_frames,
+    date_column,
+    day_rng,
+    get_last_date,
+    random_amount,
+    read_dataset,
+    write_chunks,
+)
+
+READS = {
+    "order_lines.csv": ["order__order_id", "product__product_id", "customer__customer_id", "wdf__client_id",
+                        "order_date"],
+    "orders.csv": ["order_id"],
+    "customer.csv": ["customer_id"],
+    "product.csv": ["product_id"],
+}
+# Share of order lines returned; a rate, so it does not change with SCALE_FACTOR.
+RETURN_RATE = 0.4
+
+
+def get_last_return_date(current_date):
     try:
-        df = read_csv("returns.csv")
-        df = df.with_columns(
-            pl.col("return_date").str.strptime(pl.Date, "%Y-%m-%d %H:%M:%S%.3f")
-        )
-        return df["return_date"].max()
+        last_date = get_last_date("returns.csv")
     except Exception as e:
         print(f"Could not read last return date: {e}")
-        return datetime.date.today() - datetime.timedelta(days=1)
+        last_date = None
+    return last_date or current_date - datetime.timedelta(days=1)
+
+
+def generate_returns_for_day(day, returned_lines, rng):
+    """Build the return rows for the order lines picked for one day, column by column."""
+    n = returned_lines.height
+    incr = (day - base_date_incr).days * 0.1
+    timestamp = date_column(day, n, "%Y-%m-%d 00:00:00.000")
+    return pl.DataFrame({
+        "order__order_id": returned_lines["order__order_id"],
+        "product__product_id": returned_lines["product__product_id"],
+        "customer__customer_id": returned_lines["customer__customer_id"],
+        "return_unit_cost": random_amount(5, 150, n, rng, incr),
+        "return_unit_quantity": rng.integers(1, 4, size=n).astype(float),
+        "wdf__client_id": returned_lines["wdf__client_id"],
+        "return_unit_paid_amount": random_amount(5, 200, n, rng, incr),
+        "date": timestamp,
+        "return_date": timestamp,
+    })
+
+
+def iter_returns(from_date, to_date, order_lines_df, existing_product_ids, existing_order_ids,
+                 existing_customer_ids, rng=None):
+    """Yield the returns of every day in (from_date, to_date] as one chunk per day."""
+    candidates = (
+        order_lines_df.lazy()
+        .filter(pl.col("order_date_parsed").is_between(from_date, to_date, closed="right"))
+        .join(pl.LazyFrame({"order__order_id": as_series(existing_order_ids)}), on="order__order_id", how="semi")
+        .join(pl.LazyFrame({"customer__customer_id": as_series(existing_customer_ids)}), on="customer__customer_id",
+              how="semi")
+        .collect()
+    )
+    for (current_date,), day_lines in sorted(candidates.partition_by("order_date_parsed", as_dict=True).items()):
+        day_stream = rng if rng is not None else day_rng("returns.csv", current_date)
+        returned_lines = day_lines.filter(day_stream.random(day_lines.height) < RETURN_RATE)
+        day_returns = generate_returns_for_day(current_date, returned_lines, day_stream)
+        print(f"Generated {day_returns.height} returns for {current_date}.")
+        yield day_returns
 
 
 def generate_returns(from_date, to_date, order_lines_df, existing_product_ids, existing_order_ids,
-                     existing_customer_ids):
-    new_returns = []
-    current_date = from_date + datetime.timedelta(days=1)
-
-    while current_date <= to_date:
-        orders_for_day = order_lines_df.filter(
-            pl.col("order_date_parsed") == current_date
-        )
-
-        if orders_for_day.height == 0:
-            print(f"No orders found for {current_date}. Skipping.")
-            current_date += datetime.timedelta(days=1)
-            continue
-
-        incr = (current_date - datetime.date(2022, 1, 1)).days * 0.1
-        daily_count = 0
-
-        for order in orders_for_day.iter_rows(named=True):
-            if order["order__order_id"] not in existing_order_ids or order["customer__customer_id"] not in existing_customer_ids:
-                continue
-
-            if random.random() < 0.4:
-                ret = {
-                    "return_id": generate_id("R"),
-                    "order__order_id": order["order__order_id"],
-                    "product__product_id": order["product__product_id"],
-                    "customer__customer_id": order["customer__customer_id"],
-                    "return_unit_cost": float(round(random.uniform(5, 150) + incr, 2)),
-                    "return_unit_quantity": float(random.randint(1, 3)),
-                    "wdf__client_id": order["wdf__client_id"],
-                    "return_unit_paid_amount": float(round(random.uniform(5, 200) + incr, 2)),
-                    "date": current_date.strftime("%Y-%m-%d 00:00:00.000"),
-                    "return_date": current_date.strftime("%Y-%m-%d 00:00:00.000"),
-                }
-                new_returns.append(ret)
-                daily_count += 1
-
-        print(f"Generated {daily_count} returns for {current_date}.")
-        current_date += datetime.timedelta(days=1)
-
-    return new_returns
+                     existing_customer_ids, rng=None, allocator=None):
+    """Generate the returns of every day in (from_date, to_date] as one frame."""
+    returns = concat_frames(list(iter_returns(from_date, to_date, order_lines_df, existing_product_ids,
+                                              existing_order_ids, existing_customer_ids, rng)))
+    return allocator.assign(returns) if allocator is not None else returns
 
 
 if __name__ == "__main__":
     today = datetime.date.today()
 
-    order_lines_df = read_csv("order_lines.csv")
+    last_return_date = get_last_return_date(today)
+    # Only order lines after the returns watermark can produce new returns.
+    window = (last_return_date + datetime.timedelta(days=1), today)
+    order_lines_df = read_dataset("order_lines.csv", columns=READS["order_lines.csv"], date_range=window)
     order_lines_df = order_lines_df.with_columns(
         pl.col("order_date").str.strptime(pl.Date, "%Y-%m-%d %H:%M:%S%.3f").alias("order_date_parsed")
     )
 
-    product_df = read_csv("product.csv")
-    existing_product_ids = product_df["product_id"].to_list()
-    orders_df = read_csv("orders.csv")
-    customers_df = read_csv("customer.csv")
-    existing_order_ids = set(orders_df["order_id"].to_list())
-    existing_customer_ids = set(customers_df["customer_id"].to_list())
+    product_df = read_dataset("product.csv", columns=READS["product.csv"])
+    existing_product_ids = product_df["product_id"]
+    existing_order_ids = read_dataset("orders.csv", columns=READS["orders.csv"])["order_id"]
+    existing_customer_ids = read_dataset("customer.csv", columns=READS["customer.csv"])["customer_id"]
 
-    last_return_date = get_last_return_date()
     print(f"Last return date detected: {last_return_date} — Generating up to: {today}")
 
     if last_return_date >= today:
         print("✅ Returns already up-to-date. Skipping generation.")
     else:
-        new_returns = generate_returns(last_return_date, today, order_lines_df, existing_product_ids, existing_order_ids,
-                                       existing_customer_ids)
+        written = write_chunks(
+            iter_returns(last_return_date, today, order_lines_df, existing_product_ids, existing_order_ids,
+                         existing_customer_ids),
+            "returns.csv", IdAllocator("returns.csv"),
+        )
 
-        if new_returns:
-            update_dataset("returns.csv", new_returns)
-            print(f"Updated returns.csv with {len(new_returns)} new records.")
+        if written:
+            print(f"Updated returns.csv with {written} new records.")
         else:
             print("No new returns generated.")
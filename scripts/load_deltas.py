@@ -0,0 +1,138 @@
+import os
+import tempfile
+
+import duckdb
+import polars as pl
+
+from common import (
+    DATA_DIR,
+    DATASET_SCHEMAS,
+    get_s3_client,
+    get_transfer_config,
+    read_dataset,
+    read_manifest,
+)
+
+# Datasets loaded into tables named after them (customer.csv -> customer).
+LOAD_DATASETS = ["customer.csv", "orders.csv", "order_lines.csv", "returns.csv", "monthly_inventory.csv", "product.csv"]
+# DuckDB types of the date columns the generators keep as strings; other columns follow DATASET_SCHEMAS.
+DATE_COLUMN_TYPES = {
+    "customer.csv": {"customer_created_date": "DATE"},
+    "order_lines.csv": {"date": "TIMESTAMP", "order_date": "TIMESTAMP"},
+    "returns.csv": {"date": "TIMESTAMP", "return_date": "TIMESTAMP"},
+    "monthly_inventory.csv": {"inventory_month": "DATE", "date": "TIMESTAMP"},
+}
+DUCKDB_TYPES = {pl.Utf8: "VARCHAR", pl.Float64: "DOUBLE", pl.Int64: "BIGINT"}
+# Last delta sequence number loaded per dataset; advanced in the same transaction as the rows.
+LOAD_STATE_TABLE = "_delta_loads"
+
+
+def get_database():
+    """DuckDB database to load into (DUCKDB_DATABASE, e.g. md:my_db; default: data/demo.duckdb)."""
+    return os.getenv("DUCKDB_DATABASE", os.path.join(DATA_DIR, "demo.duckdb"))
+
+
+def table_name(filename):
+    return os.path.splitext(filename)[0]
+
+
+def column_types(filename):
+    """Column name -> DuckDB type for a dataset's table."""
+    dates = DATE_COLUMN_TYPES.get(filename, {})
+    return {col: dates.get(col, DUCKDB_TYPES[dtype]) for col, dtype in DATASET_SCHEMAS[filename].items()}
+
+
+def table_exists(con, table):
+    return con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_schema = current_schema() AND table_name = ?",
+        [table],
+    ).fetchone()[0] > 0
+
+
+def create_table(con, filename):
+    columns = ", ".join(f'"{col}" {dtype}' for col, dtype in column_types(filename).items())
+    con.execute(f'CREATE TABLE "{table_name(filename)}" ({columns})')
+
+
+def insert_parquet(con, filename, paths):
+    """Insert Parquet files into a dataset's table, casting every column to its typed schema; returns rows inserted."""
+    types = column_types(filename)
+    columns = ", ".join(f'"{col}"' for col in types)
+    casts = ", ".join(f'CAST("{col}" AS {dtype})' for col, dtype in types.items())
+    files = ", ".join("'" + path.replace("'", "''") + "'" for path in paths)
+    return con.execute(
+        f'INSERT INTO "{table_name(filename)}" ({columns}) SELECT {casts} FROM read_parquet([{files}])'
+    ).fetchone()[0]
+
+
+def fetch_delta(key, tmpdir):
+    """Local path of a delta file, downloading it from S3 into tmpdir when USE_S3=true."""
+    if os.getenv("USE_S3", "false").lower() != "true":
+        return os.path.join(DATA_DIR, key)
+    path = os.path.join(tmpdir, key.replace("/", "_"))
+    get_s3_client().download_file(os.getenv("AWS_S3_BUCKET"), key, path, Config=get_transfer_config())
+    return path
+
+
+def load_dataset(con, filename, tmpdir):
+    """
+    Load the deltas of one dataset that the database has not seen yet. A
+    missing table is created and filled from the full dataset once; it then
+    counts as having every delta listed so far. Returns the rows inserted.
+    """
+    table = table_name(filename)
+    manifest = read_manifest(filename) or {}
+    deltas = manifest.get("deltas", [])
+    row = con.execute(f"SELECT last_seq FROM {LOAD_STATE_TABLE} WHERE dataset = ?", [table]).fetchone()
+    last_seq = row[0] if row else 0
+
+    con.begin()
+    try:
+        if not table_exists(con, table):
+            try:
+                history = read_dataset(filename)
+            except FileNotFoundError:
+                con.rollback()
+                print(f"⚠️ {filename} does not exist yet. Skipping.")
+                return 0
+            print(f"🧱 Creating {table} from the full {filename}")
+            create_table(con, filename)
+            snapshot = os.path.join(tmpdir, f"{table}.parquet")
+            history.cast(DATASET_SCHEMAS[filename]).write_parquet(snapshot)
+            inserted = insert_parquet(con, filename, [snapshot])
+            last_seq = deltas[-1]["seq"] if deltas else 0
+        else:
+            pending = [d for d in deltas if d["seq"] > last_seq]
+            if not pending:
+                con.rollback()
+                print(f"✅ {table} is up to date (delta {last_seq}).")
+                return 0
+            inserted = insert_parquet(con, filename, [fetch_delta(d["key"], tmpdir) for d in pending])
+            last_seq = pending[-1]["seq"]
+        con.execute(
+            f"INSERT OR REPLACE INTO {LOAD_STATE_TABLE} VALUES (?, ?, current_timestamp)", [table, last_seq]
+        )
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    print(f"✅ Loaded {inserted} rows into {table} (delta {last_seq}).")
+    return inserted
+
+
+def load_deltas(database=None, datasets=None):
+    """Load every dataset's pending deltas into a DuckDB/MotherDuck database; returns rows inserted per table."""
+    con = duckdb.connect(database or get_database())
+    try:
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {LOAD_STATE_TABLE} "
+            "(dataset VARCHAR PRIMARY KEY, last_seq INTEGER, loaded_at TIMESTAMP)"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return {table_name(f): load_dataset(con, f, tmpdir) for f in datasets or LOAD_DATASETS}
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    load_deltas()
@@ -0,0 +1,363 @@
+import argparse
+import datetime
+import graphlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import polars as pl
+
+from common import (
+    DATASET_SCHEMAS,
+    MERCHANT_TYPES,
+    PRIMARY_KEYS,
+    ChunkWriter,
+    IdAllocator,
+    Snapshot,
+    concat_frames,
+    day_rng,
+    filter_date_range,
+    measure_stage,
+    publish,
+    random_choice,
+    read_dataset,
+    release_snapshots,
+    write_behind,
+)
+from generate_customers import LOCATION_COLUMNS, READS as CUSTOMERS_READS, generate_customers
+from generate_monthly_inventory import READS as INVENTORY_READS, generate_monthly_inventory
+from generate_order_lines import READS as ORDER_LINES_READS, generate_order_lines, get_last_order_line_date
+from generate_orders import READS as ORDERS_READS, generate_orders_range, get_last_order_date, update_orders_meta
+from generate_returns import READS as RETURNS_READS, generate_returns, get_last_return_date
+
+
+class PipelineContext:
+    """Tables shared by every stage of one run: each stored table read once, plus this run's new rows."""
+
+    def __init__(self, today, reads=None, snapshot_dir=None):
+        self.today = today
+        self.reads = reads or {}
+        self.snapshot_dir = snapshot_dir
+        self.history = {}
+        self.new_rows = {}
+        self.allocators = {}
+        self.snapshots = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def allocator(self, filename):
+        """Return this run's IdAllocator for a dataset."""
+        with self._lock:
+            if filename not in self.allocators:
+                self.allocators[filename] = IdAllocator(filename)
+            return self.allocators[filename]
+
+    def history_table(self, filename, date_range=None):
+        key = (filename, date_range)
+        # Stages run concurrently; the per-table lock makes the second reader wait for the first load.
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            if key not in self.history:
+                columns = self.reads.get(filename)
+                # The primary key is always read, so rows this run already flushed can be told apart (see table).
+                primary_key = PRIMARY_KEYS.get(filename)
+                if columns is not None and primary_key is not None and primary_key not in columns:
+                    columns = [primary_key, *columns]
+                try:
+                    self.history[key] = read_dataset(filename, columns=columns, date_range=date_range)
+                except FileNotFoundError:
+                    print(f"⚠️ {filename} does not exist yet. Starting from an empty table.")
+                    empty = pl.DataFrame(schema=DATASET_SCHEMAS.get(filename))
+                    self.history[key] = empty.select(columns) if columns is not None else empty
+        return self.history[key]
+
+    def reference(self, name, build):
+        """Return the Snapshot of a reference dimension, built by build() the first time it is asked for."""
+        with self._lock:
+            load_lock = self._load_locks.setdefault(("snapshot", name), threading.Lock())
+        with load_lock:
+            if name not in self.snapshots:
+                df = build()
+                if self.snapshot_dir is not None:
+                    df = Snapshot.write(df, os.path.join(self.snapshot_dir, f"{name}.arrow"))
+                self.snapshots[name] = df
+        return self.snapshots[name]
+
+    def product_ids(self):
+        return self.reference("product_ids", lambda: self.table("product.csv").select("product_id"))["product_id"]
+
+    def customer_ids(self):
+        return self.reference("customer_ids", lambda: self.table("customer.csv").select("customer_id"))["customer_id"]
+
+    def order_ids(self):
+        return self.reference("order_ids", lambda: self.table("orders.csv").select("order_id"))["order_id"]
+
+    def table(self, filename, date_range=None):
+        """Return the stored rows of a dataset plus the rows generated so far in this run."""
+        history = self.history_table(filename, date_range)
+        new_rows = self.new_rows.get(filename)
+        if new_rows is None or new_rows.is_empty():
+            return history
+        new_rows = filter_date_range(new_rows, filename, date_range)
+        # History read after a stage flushed its rows already holds them; keep the in-memory copy.
+        key = PRIMARY_KEYS.get(filename)
+        if key in history.columns and key in new_rows.columns:
+            history = history.filter(~pl.col(key).is_in(new_rows[key].implode()))
+        return pl.concat([history, new_rows], how="diagonal_relaxed")
+
+
+class StageOutput:
+    """Streams a stage's rows to storage through a ChunkWriter, keeping the keep columns of the rows it accepted."""
+
+    def __init__(self, ctx, filename, keep):
+        self.allocator = ctx.allocator(filename)
+        self.writer = ChunkWriter(filename, self.allocator)
+        self.keep = set(keep)
+        self.stored = set(DATASET_SCHEMAS.get(filename, {}))
+        self.rows = 0
+        self._pending = []
+        self._kept = []
+
+    def write(self, df):
+        if df.is_empty():
+            return
+        if self.allocator.column not in df.columns:
+            df = self.allocator.assign(df)
+        self._pending.append(df.select([c for c in df.columns if c in self.keep or c not in self.stored]))
+        self.accept(self.writer.write(df))
+
+    def accept(self, accepted):
+        """Keep the buffered rows of a flush that validation accepted; rejected rows were never stored."""
+        if accepted is None:
+            return
+        pending = concat_frames(self._pending)
+        self._pending = []
+        key = self.allocator.column
+        self._kept.append(pending.filter(pl.col(key).is_in(accepted[key].implode())))
+        self.rows += accepted.height
+
+    def close(self):
+        """Flush the remaining rows; returns the kept columns of every row accepted."""
+        self.accept(self.writer.flush())
+        return concat_frames(self._kept)
+
+
+def get_workers():
+    """Worker count for concurrent stages and date shards (PIPELINE_WORKERS, default: CPU count)."""
+    return int(os.getenv("PIPELINE_WORKERS", str(os.cpu_count() or 1)))
+
+
+def date_shards(from_date, to_date, shard_days):
+    """Split the (from_date, to_date] range generators work on into consecutive windows of shard_days."""
+    shards = []
+    start = from_date
+    while start < to_date:
+        end = min(start + datetime.timedelta(days=shard_days), to_date)
+        shards.append((start, end))
+        start = end
+    return shards
+
+
+def _run_shard(task):
+    fn, args, kwargs = task
+    return fn(*args, **kwargs)
+
+
+def run_sharded(fn, from_date, to_date, shard_args, output):
+    """Run fn over SHARD_DAYS-long shards of (from_date, to_date] in a process pool, writing results to output in date order."""
+    shards = date_shards(from_date, to_date, int(os.getenv("SHARD_DAYS", "31")))
+    tasks = [(fn, (start, end) + tuple(shard_args(start, end)), {}) for start, end in shards]
+    workers = min(get_workers(), len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            output.write(_run_shard(task))
+        return
+    # Polars is multi-threaded, so workers are spawned rather than forked.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_run_shard, task))
+            if len(pending) > workers:
+                output.write(pending.popleft().result())
+        while pending:
+            output.write(pending.popleft().result())
+
+
+def run_customers(ctx, output):
+    customers = ctx.table("customer.csv")
+    output.write(generate_customers(
+        ctx.today,
+        ctx.reference("customer_locations", lambda: customers.select(LOCATION_COLUMNS).unique(maintain_order=True)),
+        MERCHANT_TYPES,
+        customers["customer_id"],
+        existing_emails=customers["customer_email"],
+        allocator=ctx.allocator("customer.csv"),
+    ))
+
+
+def run_orders(ctx, output):
+    last_date = get_last_order_date(ctx.today)
+    print(f"📅 Last order date: {last_date} — Generating up to: {ctx.today}")
+    if last_date >= ctx.today:
+        print("✅ Orders already up-to-date. Skipping generation.")
+        return
+
+    customer_ids = ctx.customer_ids()
+    run_sharded(generate_orders_range, last_date, ctx.today, lambda start, end: (customer_ids,), output)
+
+
+def run_order_lines(ctx, output):
+    last_date = get_last_order_line_date(ctx.today)
+    print(f"Last order line date detected: {last_date}")
+    if last_date >= ctx.today:
+        return
+
+    customer_ids = ctx.customer_ids()
+    orders = ctx.table("orders.csv")
+    # Stored orders carry no customer_id; only this run's orders know theirs.
+    if "customer_id" not in orders.columns:
+        orders = orders.with_columns(pl.lit(None, dtype=pl.Utf8).alias("customer_id"))
+    orders = orders.with_columns(
+        pl.coalesce(pl.col("customer_id"), pl.lit(random_choice(customer_ids, orders.height, day_rng("orders.csv:customer_id", ctx.today))))
+    )
+    product_ids = ctx.product_ids()
+    run_sharded(
+        generate_order_lines, last_date, ctx.today, lambda start, end: (orders, product_ids, customer_ids), output
+    )
+
+
+def run_returns(ctx, output):
+    last_return_date = get_last_return_date(ctx.today)
+    print(f"Last return date detected: {last_return_date} — Generating up to: {ctx.today}")
+    if last_return_date >= ctx.today:
+        print("✅ Returns already up-to-date. Skipping generation.")
+        return
+
+    # Only order lines after the returns watermark can produce new returns.
+    window = (last_return_date + datetime.timedelta(days=1), ctx.today)
+    order_lines = ctx.table("order_lines.csv", date_range=window).with_columns(
+        pl.col("order_date").str.strptime(pl.Date, "%Y-%m-%d %H:%M:%S%.3f").alias("order_date_parsed")
+    )
+    product_ids = ctx.product_ids()
+    order_ids = ctx.order_ids()
+    customer_ids = ctx.customer_ids()
+
+    def shard_args(start, end):
+        shard_lines = order_lines.filter(pl.col("order_date_parsed").is_between(start, end, closed="right"))
+        return shard_lines, product_ids, order_ids, customer_ids
+
+    run_sharded(generate_returns, last_return_date, ctx.today, shard_args, output)
+
+
+def run_monthly_inventory(ctx, output):
+    output.write(generate_monthly_inventory(
+        ctx.today, ctx.product_ids(), allocator=ctx.allocator("monthly_inventory.csv"),
+        existing_months=ctx.table("monthly_inventory.csv")["inventory_month"],
+    ))
+
+
+# Stage name -> output dataset, upstream stages, generator (run(ctx, output)) and the input columns it reads.
+STAGES = {
+    "customers": {"dataset": "customer.csv", "deps": [], "run": run_customers, "reads": CUSTOMERS_READS},
+    "orders": {"dataset": "orders.csv", "deps": ["customers"], "run": run_orders, "reads": ORDERS_READS},
+    "order_lines": {"dataset": "order_lines.csv", "deps": ["orders"], "run": run_order_lines,
+                    "reads": ORDER_LINES_READS},
+    "returns": {"dataset": "returns.csv", "deps": ["order_lines"], "run": run_returns, "reads": RETURNS_READS},
+    "monthly_inventory": {"dataset": "monthly_inventory.csv", "deps": [], "run": run_monthly_inventory,
+                          "reads": INVENTORY_READS},
+}
+
+
+def stage_reads(stages=None):
+    """Union of the columns the selected stages read, per input dataset, in first-declared order."""
+    reads = {}
+    for name in stage_order(stages):
+        for filename, columns in STAGES[name]["reads"].items():
+            merged = reads.setdefault(filename, [])
+            merged.extend(c for c in columns if c not in merged)
+    return reads
+
+
+def stage_order(stages=None):
+    """Topologically sorted stage names, restricted to stages if given."""
+    selected = set(stages or STAGES)
+    graph = {name: [d for d in spec["deps"] if d in selected] for name, spec in STAGES.items() if name in selected}
+    return list(graphlib.TopologicalSorter(graph).static_order())
+
+
+def kept_columns(name, stages=None):
+    """Columns of a stage's output that stay in memory: its primary key and what the other selected stages read."""
+    dataset = STAGES[name]["dataset"]
+    columns = [PRIMARY_KEYS[dataset]]
+    for other in stage_order(stages):
+        if other != name:
+            columns.extend(STAGES[other]["reads"].get(dataset, []))
+    return columns
+
+
+def run_stage(name, ctx, stages=None):
+    """Run one stage's generator and write its rows, measured as its generate stage."""
+    dataset = STAGES[name]["dataset"]
+    with measure_stage("generate", dataset) as record:
+        output = StageOutput(ctx, dataset, kept_columns(name, stages))
+        STAGES[name]["run"](ctx, output)
+        new_rows = output.close()
+        record["rows_out"] = output.rows
+    return new_rows
+
+
+def run_stages(ctx, stages=None):
+    """Run the selected stages, each on a thread as soon as its upstream stages are done."""
+    selected = set(stages or STAGES)
+    sorter = graphlib.TopologicalSorter(
+        {name: [d for d in spec["deps"] if d in selected] for name, spec in STAGES.items() if name in selected}
+    )
+    sorter.prepare()
+    with ThreadPoolExecutor(max_workers=max(1, min(get_workers(), len(selected)))) as pool:
+        running = {}
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                running[pool.submit(run_stage, name, ctx, stages)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                new_rows = future.result()
+                ctx.new_rows[STAGES[name]["dataset"]] = new_rows
+                print(f"Generated {len(new_rows)} new {name} records.")
+                sorter.done(name)
+
+
+def run_pipeline(today=None, stages=None):
+    """Run the selected stages (all by default) in one process, then move the orders watermark."""
+    with write_behind():
+        with tempfile.TemporaryDirectory(prefix="demo-data-reference-") as snapshot_dir:
+            ctx = PipelineContext(today or datetime.date.today(), stage_reads(stages), snapshot_dir)
+            try:
+                run_stages(ctx, stages)
+            finally:
+                release_snapshots(snapshot_dir)
+        if not ctx.new_rows.get("orders.csv", pl.DataFrame()).is_empty():
+            publish("orders.csv", lambda: update_orders_meta(ctx.today))
+    return ctx
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate all datasets in one process.")
+    parser.add_argument("stages", nargs="*", help=f"Stages to run (default: all): {', '.join(STAGES)}.")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible output (default: GENERATION_SEED).")
+    parser.add_argument("--scale-factor", type=float,
+                        help="Multiplier for every dataset's daily volume (default: SCALE_FACTOR or 1).")
+    args = parser.parse_args()
+    # Both are set in the environment so spawned shard workers see them too.
+    if args.seed is not None:
+        os.environ["GENERATION_SEED"] = str(args.seed)
+    if args.scale_factor is not None:
+        os.environ["SCALE_FACTOR"] = str(args.scale_factor)
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    run_pipeline(stages=args.stages or None)